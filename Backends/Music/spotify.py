@@ -1,6 +1,8 @@
 import sys
 import os
 import asyncio
+import time
+import re
 import discord
 # Add the parent directory to the system path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -10,41 +12,190 @@ from librespot.metadata import TrackId
 from librespot.audio.decoders import AudioQuality, VorbisOnlyAudioQuality
 import spotipy
 
+## Seconds an unused session is kept logged in
+session_idle_timeout = 600
+
+## Refresh the api token when it has less than this many seconds left
+token_refresh_margin = 300
+
+class SessionPool:
+    """Keeps one logged in librespot session per stored credential."""
+    def __init__(self):
+        self._sessions = {} # key -> [session, last used, streams playing from it]
+        self._tokens = {} # key -> (StoredToken, time it was fetched)
+        self._locks = {} # key -> lock, so a credential only logs in once at a time
+        self._retired = [] # dropped [session, last used, streams] entries, closed once their last stream is released
+
+    async def session(self, key, lease=False):
+        """Returns the session for key, logging in if needed. A leased session is not evicted until release() is called."""
+        loop = asyncio.get_running_loop()
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._sessions.get(key)
+            if entry is None:
+                # the login handshake is blocking network io
+                session = await loop.run_in_executor(None, lambda: lbc.Session.Builder().stored(key).create())
+                entry = self._sessions[key] = [session, 0, 0]
+            entry[1] = time.monotonic()
+            if lease:
+                entry[2] += 1
+        return entry[0]
+
+    def release(self, key, session):
+        entry = self._sessions.get(key)
+        if entry is not None and entry[0] is session:
+            entry[1] = time.monotonic()
+            entry[2] = max(0, entry[2] - 1)
+            return
+        # the session was dropped while the stream played, it can be closed once nothing reads from it
+        for entry in self._retired:
+            if entry[0] is session:
+                entry[2] -= 1
+                if entry[2] <= 0:
+                    self._retired.remove(entry)
+                    self._close(entry[0])
+                return
+
+    async def token(self, key, scope="playlist-read"):
+        session = await self.session(key)
+        entry = self._tokens.get(key)
+        if entry is None or entry[1] + entry[0].expires_in - token_refresh_margin < time.monotonic():
+            token = await asyncio.get_running_loop().run_in_executor(None, session.tokens().get_token, scope)
+            entry = self._tokens[key] = (token, time.monotonic())
+        return entry[0].access_token
+
+    def drop(self, key):
+        entry = self._sessions.pop(key, None)
+        self._tokens.pop(key, None)
+        lock = self._locks.get(key)
+        if lock is not None and not lock.locked():
+            del self._locks[key]
+        if entry is None:
+            return
+        if entry[2] > 0:
+            # other streams on this credential are still playing from it, the next call logs in again instead
+            self._retired.append(entry)
+            return
+        self._close(entry[0])
+
+    def _close(self, session):
+        try:
+            session.close()
+        except Exception:
+            pass
+
+    def evict(self):
+        now = time.monotonic()
+        for key, entry in list(self._sessions.items()):
+            # a session still streaming a track is in use however long ago it was fetched
+            if entry[2] == 0 and now - entry[1] > session_idle_timeout:
+                self.drop(key)
+
+sessions = SessionPool()
+
+def reclaim():
+    # called from the bots reclaim loop
+    sessions.evict()
+
 async def search(query:str, user: discord.User, count:int=5, key = None):
-    session = lbc.Session.Builder().stored(key).create()
-    oauth_token = session.tokens().get("playlist-read")
-    sp = spotipy.Spotify(auth=oauth_token)
-    results = sp.search(q=query, type='track', limit=count)["tracks"]["items"]
+    """Yields the songs spotify found, spotify answers a search in one response."""
+    try:
+        sp = spotipy.Spotify(auth=await sessions.token(key))
+        results = await asyncio.get_running_loop().run_in_executor(None, lambda: sp.search(q=query, type='track', limit=count))
+    except Exception:
+        # the session may have been closed by spotify, log in again next time
+        sessions.drop(key)
+        raise
+    results = results["tracks"]["items"]
     
-    songs = []
     for result in results[:count]:
-        video_title = result['name']
-        video_url = result['uri']
-        length = int(result['duration_ms']/1000)
-        author = ", ".join([result["artists"][i]["name"] for i in range(len(result["artists"]))])
-        songs.append(libTempo.Song(None or user, video_title, author, "spotify", length, video_url))
+        yield _tracktosong(result, user)
+
+def _tracktosong(result, user):
+    video_title = result['name']
+    video_url = result['uri']
+    length = int(result['duration_ms']/1000)
+    author = ", ".join([result["artists"][i]["name"] for i in range(len(result["artists"]))])
+    return libTempo.Song(None or user, video_title, author, "spotify", length, video_url)
+
+## Number of playlist pages requested at once
+playlist_concurrency = 4
+
+def _parseplaylist(url):
+    # accepts open.spotify.com links and spotify: uris, anchored so searches like "album:Thriller" stay searches
+    match = re.match(r"(?:https?://open\.spotify\.com/(?:intl-[a-z]+/)?(playlist|album)/|spotify:(playlist|album):)([A-Za-z0-9]+)", url.strip())
+    if match is None:
+        return None, None
+    return match.group(1) or match.group(2), match.group(3)
 
-    return songs
+def isplaylist(query: str):
+    return _parseplaylist(query)[0] is not None
+
+async def getplaylist(url: str, user: discord.User, key = None):
+    """Yields the songs of a spotify playlist or album a page at a time, fetching pages concurrently."""
+    kind, id = _parseplaylist(url)
+    if kind is None:
+        raise ValueError("Not a spotify playlist or album.")
+    loop = asyncio.get_running_loop()
+    sp = spotipy.Spotify(auth=await sessions.token(key))
+    limit = 100 if kind == "playlist" else 50
+    def fetch(offset):
+        if kind == "playlist":
+            page = sp.playlist_items(id, offset=offset, limit=limit, additional_types=("track",))
+            return page["total"], [item["track"] for item in page["items"] if item.get("track")]
+        page = sp.album_tracks(id, offset=offset, limit=limit)
+        return page["total"], page["items"]
+
+    # the first page tells us how many there are, the rest are requested in parallel
+    total, tracks = await loop.run_in_executor(None, fetch, 0)
+    yield [_tracktosong(track, user) for track in tracks if track.get("uri")]
+    semaphore = asyncio.Semaphore(playlist_concurrency)
+    async def fetchpage(offset):
+        async with semaphore:
+            return await loop.run_in_executor(None, fetch, offset)
+    tasks = [asyncio.create_task(fetchpage(offset)) for offset in range(limit, total, limit)]
+    try:
+        # pages are yielded in order, each as soon as it and the ones before it have arrived
+        for task in tasks:
+            _, tracks = await task
+            yield [_tracktosong(track, user) for track in tracks if track.get("uri")]
+    finally:
+        for task in tasks:
+            task.cancel()
 
 class ByteAudioSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, stream,volume=0.5):
+    def __init__(self, source, *, stream,volume=0.5, onclose=None):
         super().__init__(source,volume)
         self.stream = stream
+        self.onclose = onclose
     @classmethod
-    async def get_stream(cls, stream):
+    async def get_stream(cls, stream, onclose=None):
         ffmpeg_options = {
             'options': '-vn',
         }
-        return cls(discord.FFmpegPCMAudio(stream, **ffmpeg_options, pipe=True), stream=stream)
+        return cls(discord.FFmpegPCMAudio(stream, **ffmpeg_options, pipe=True), stream=stream, onclose=onclose)
+    def cleanup(self):
+        super().cleanup()
+        onclose, self.onclose = self.onclose, None
+        if onclose is not None:
+            onclose()
 
 
 async def getstream(url: str, user: discord.User):
-    key = libTempo.getuserdata(user)["keys"]["spotify"]
-    session = lbc.Session.Builder().stored(key).create()
+    key = (await libTempo.agetuserdata(user))["keys"]["spotify"]
+    # leased until the stream is cleaned up, so a long track is not logged out mid playback
+    session = await sessions.session(key, lease=True)
     track_id = TrackId.from_uri(url)
-    stream = session.content_feeder().load(track_id, VorbisOnlyAudioQuality(AudioQuality.VERY_HIGH), False, None)
-    audio = stream.input_stream
-    song = await ByteAudioSource.get_stream(stream=audio.stream())
+    try:
+        stream = await asyncio.get_running_loop().run_in_executor(None, lambda: session.content_feeder().load(track_id, VorbisOnlyAudioQuality(AudioQuality.VERY_HIGH), False, None))
+        audio = stream.input_stream
+        # streams are cleaned up on the audio thread, the pool is only touched on the event loop
+        loop = asyncio.get_running_loop()
+        song = await ByteAudioSource.get_stream(stream=audio.stream(), onclose=lambda: loop.call_soon_threadsafe(sessions.release, key, session))
+    except Exception:
+        sessions.release(key, session)
+        sessions.drop(key)
+        raise
     return song
 
 
@@ -1,6 +1,11 @@
 import sys
 import os
 import asyncio
+import time
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
 import discord
 # Add the parent directory to the system path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -8,25 +13,215 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import libTempo
 import yt_dlp as youtube_dl
 
-async def search(query:str, user: discord.User, count:int=5, key = None):
-    ydl_opts = {
-        'default_search': 'ytsearch',  # Use YouTube search
-        'ignoreerrors': True,  # Ignore any errors during extraction
-        'quiet': True  # Suppress console output
-    }
-
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-        search_results = ydl.extract_info(f"ytsearch5:{query}", download=False)
+## Number of threads running youtube searches
+search_workers = 4
+
+## Seconds a search result is reused for
+search_cache_ttl = 120
+
+search_opts = {
+    'default_search': 'ytsearch',  # Use YouTube search
+    'extract_flat': True,  # Only read the search page, full info is fetched for the picked result
+    'ignoreerrors': True,  # Ignore any errors during extraction
+    'quiet': True  # Suppress console output
+}
+searchpool = ThreadPoolExecutor(max_workers=search_workers, thread_name_prefix="ytsearch")
+searchcache = libTempo.Cache("ytsearch", maxsize=256, ttl=search_cache_ttl)
+_searches = {} # searches that are currently running, so identical queries share one request
+_local = threading.local()
+
+def _search(query, count, found=None):
+    # YoutubeDL is not thread safe, every worker keeps its own instance
+    if not hasattr(_local, "ydl"):
+        _local.ydl = youtube_dl.YoutubeDL(search_opts)
+    # process=False hands back the entries as they are read off the results page
+    search_results = _local.ydl.extract_info(f"ytsearch{count}:{query}", download=False, process=False)
     results = []
     # Process the search results
-    for result in search_results['entries'][:count]:
-        video_title = result['title']
-        video_url = result['webpage_url']
-        length = result['duration']
-        author = result["channel"]
-        results.append(libTempo.Song(None or user, video_title, author, "youtube", length, video_url))
+    for result in itertools.islice(search_results['entries'], count):
+        if result is None:
+            continue
+        url = result.get('webpage_url') or result.get('url') or f"https://www.youtube.com/watch?v={result['id']}"
+        author = result.get('channel') or result.get('uploader') or "Unknown"
+        results.append((result['title'], author, int(result.get('duration') or 0), url))
+        if found is not None:
+            found(results[-1])
     return results
 
+async def search(query:str, user: discord.User, count:int=5, key = None):
+    """Yields songs as the search finds them."""
+    cachekey = (query.strip().lower(), count)
+    results = await searchcache.aget(cachekey)
+    if results is None:
+        future = _searches.get(cachekey)
+        if future is not None:
+            # someone else is already running this search, shielded so a cancelled caller does not cancel it for them
+            results = await asyncio.shield(future)
+        else:
+            loop = asyncio.get_running_loop()
+            found = asyncio.Queue()
+            future = loop.run_in_executor(searchpool, _search, query, count, lambda result: loop.call_soon_threadsafe(found.put_nowait, result))
+            _searches[cachekey] = future
+            def done(future):
+                _searches.pop(cachekey, None)
+                found.put_nowait(None)
+                if not future.cancelled() and future.exception() is None:
+                    searchcache.set(cachekey, future.result())
+            future.add_done_callback(done)
+            while (result := await found.get()) is not None:
+                title, author, length, url = result
+                yield libTempo.Song(None or user, title, author, "youtube", length, url, resolved=False)
+            # raises if the search failed
+            await future
+            return
+    for title, author, length, url in results:
+        yield libTempo.Song(None or user, title, author, "youtube", length, url, resolved=False)
+
+## Number of playlists that can be imported at once
+playlist_workers = 2
+
+# an import holds its thread until the whole playlist is read, so it doesnt get to block searches
+playlistpool = ThreadPoolExecutor(max_workers=playlist_workers, thread_name_prefix="ytplaylist")
+
+def isplaylist(query: str):
+    return query.startswith(("http://", "https://")) and "list=" in query
+
+def _entrytosong(entry, user):
+    url = entry.get('webpage_url') or entry.get('url') or f"https://www.youtube.com/watch?v={entry['id']}"
+    author = entry.get('channel') or entry.get('uploader') or "Unknown"
+    return libTempo.Song(user, entry.get('title') or url, author, "youtube", int(entry.get('duration') or 0), url, resolved=False)
+
+async def getplaylist(url: str, user: discord.User, key = None, pagesize: int = 100):
+    """Yields the songs of a youtube playlist a page at a time, as yt-dlp reads them."""
+    loop = asyncio.get_running_loop()
+    pages = asyncio.Queue(maxsize=4)
+    stopped = threading.Event()
+
+    def put(item):
+        # blocks the worker while the queue is full, gives up once nobody is listening
+        while not stopped.is_set():
+            try:
+                asyncio.run_coroutine_threadsafe(asyncio.wait_for(pages.put(item), 1), loop).result()
+                return
+            except (asyncio.TimeoutError, TimeoutError):
+                continue
+
+    def produce():
+        try:
+            ydl = youtube_dl.YoutubeDL({**search_opts, 'extract_flat': 'in_playlist'})
+            # process=False leaves the entries as a lazy generator, pages are fetched while we iterate
+            info = ydl.extract_info(url, download=False, process=False)
+            if info.get('_type') in ('url', 'url_transparent'):
+                # watch links with a list= point at the playlist instead of containing it
+                info = ydl.extract_info(info['url'], download=False, process=False)
+            page = []
+            for entry in info.get('entries') or []:
+                if stopped.is_set():
+                    return
+                if entry is None:
+                    continue
+                page.append(entry)
+                if len(page) == pagesize:
+                    put(page)
+                    page = []
+            if page:
+                put(page)
+        finally:
+            put(None)
+
+    future = loop.run_in_executor(playlistpool, produce)
+    try:
+        while True:
+            page = await pages.get()
+            if page is None:
+                break
+            yield [_entrytosong(entry, user) for entry in page]
+        await future
+    finally:
+        # let the worker finish if we stopped listening early
+        stopped.set()
+        while not pages.empty():
+            pages.get_nowait()
+
+## Maximum number of resolved streams kept in memory
+stream_cache_size = 512
+
+## Fields of an extraction the stream cache keeps, nothing reads the rest of what yt-dlp returns
+stream_fields = ("url", "webpage_url", "duration", "channel", "uploader")
+
+## Seconds before a signed stream url expires that it stops being reused
+stream_expiry_margin = 120
+
+## How long to keep a stream when its url has no expiry
+stream_default_ttl = 1800
+
+youtube_dl.utils.bug_reports_message = lambda: ''
+ydl_opts = {
+    'format': 'bestaudio/best',
+    'restrictfilenames': True,
+    'noplaylist': True,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0'
+}
+ffmpeg_options = {
+    'options': '-vn',
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+}
+
+def _ytdl():
+    # YoutubeDL is not thread safe, prefetches and resolves run at the same time so every thread keeps its own
+    if not hasattr(_local, "ytdl"):
+        _local.ytdl = youtube_dl.YoutubeDL(ydl_opts)
+    return _local.ytdl
+
+def _extractinfo(url, download):
+    ytdl = _ytdl()
+    return ytdl.sanitize_info(ytdl.extract_info(url, download=download))
+
+_extractions = {} # extractions that are currently running, so a resolve and a prefetch of one url share a request
+
+# webpage url -> the stream_fields of its extracted info
+streamcache = libTempo.Cache("ytstream", maxsize=stream_cache_size)
+
+def _stream_ttl(data):
+    """Works out how long a resolved stream can be reused from the expiry signed into its url."""
+    query = parse_qs(urlparse(data.get('url', '')).query)
+    expire = query.get('expire')
+    if expire is None:
+        return stream_default_ttl
+    try:
+        return int(expire[0]) - time.time() - stream_expiry_margin
+    except ValueError:
+        return stream_default_ttl
+
+async def _extract(url, *, loop=None, stream=True):
+    loop = loop or asyncio.get_event_loop()
+    data = await streamcache.aget(url) if stream else None
+    if data is None:
+        key = (url, stream)
+        future = _extractions.get(key)
+        if future is None:
+            future = loop.run_in_executor(None, _extractinfo, url, not stream)
+            _extractions[key] = future
+            future.add_done_callback(lambda _: _extractions.pop(key, None))
+        data = await asyncio.shield(future)
+        if 'entries' in data:
+            # take first item from a youtube playlist
+            data = data['entries'][0]
+        if stream:
+            # the full info has every format, thumbnail and header, far too much to keep or share between processes
+            data = {field: data[field] for field in stream_fields if field in data}
+            ttl = _stream_ttl(data)
+            streamcache.set(url, data, ttl)
+            if data.get('webpage_url') and data['webpage_url'] != url:
+                streamcache.set(data['webpage_url'], data, ttl)
+    return data
+
 class YTDLSource(discord.PCMVolumeTransformer):
     def __init__(self, source, *, data, volume=0.5):
         super().__init__(source, volume)
@@ -34,31 +229,9 @@ class YTDLSource(discord.PCMVolumeTransformer):
         self.url = data.get('url')
     @classmethod
     async def from_url(cls, url, *, loop=None, stream=False):
-        youtube_dl.utils.bug_reports_message = lambda: ''
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'restrictfilenames': True,
-            'noplaylist': True,
-            'nocheckcertificate': True,
-            'ignoreerrors': False,
-            'logtostderr': False,
-            'quiet': True,
-            'no_warnings': True,
-            'default_search': 'auto',
-            'source_address': '0.0.0.0'
-        }
-        ffmpeg_options = {
-            'options': '-vn',
-            'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
-        }
-        ytdl = youtube_dl.YoutubeDL(ydl_opts)
         loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.sanitize_info(ytdl.extract_info(url, download=not stream)))
-        if 'entries' in data:
-            # take first item from a youtube playlist
-            data = data['entries'][0]
-
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
+        data = await _extract(url, loop=loop, stream=stream)
+        filename = data['url'] if stream else _ytdl().prepare_filename(data)
         return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
 
 
@@ -66,5 +239,17 @@ async def getstream(url: str, user: discord.User = None):
     return await YTDLSource.from_url(url, loop=asyncio.get_event_loop(), stream=True)
 
 
+async def resolve(song):
+    """Fetches full info for a song picked from a flat search, filling in anything the search page left out."""
+    if song.resolved:
+        return song
+    data = await _extract(song.url)
+    if not song.length:
+        song.length = int(data.get('duration') or 0)
+    song.author = data.get('channel') or data.get('uploader') or song.author
+    song.resolved = True
+    return song
+
+
 def auth(username, key):
     return ""
\ No newline at end of file
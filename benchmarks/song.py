@@ -0,0 +1,56 @@
+"""Memory used by a queue of Songs, compared with the plain class Song used to be.
+
+Run from the repository root: python benchmarks/song.py [tracks]
+"""
+import os
+import sys
+import json
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import libTempo
+
+
+class PlainSong:
+    # Song before it was slotted, holding the whole user
+    def __init__(self, user, title, author, backend, length, url):
+        self.user = user
+        self.title = title
+        self.author = author
+        self.backend = backend
+        self.length = length
+        self.url = url
+
+class User:
+    def __init__(self, id):
+        self.id = id
+        self.name = f"user{id}"
+
+
+def build(cls, count, users):
+    songs = []
+    for i in range(count):
+        # decoded per track like a search or playlist response, so equal strings are separate objects until interned
+        title, author, backend, url = json.loads(json.dumps([f"Track {i}", f"Artist {i % 300}", "youtube", f"https://www.youtube.com/watch?v={i:011d}"]))
+        songs.append(cls(users[i % len(users)], title, author, backend, 200 + i % 100, url))
+    return songs
+
+def measure(cls, count, users):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    songs = build(cls, count, users)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del songs
+    return size
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    users = [User(i) for i in range(20)]
+    for name, cls in [("plain class", PlainSong), ("slotted Song", libTempo.Song)]:
+        size = measure(cls, count, users)
+        print(f"{name:14} {size // 1024:6} KiB ({size // count} B/track)")
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,10 @@ import sqlite3
 import discord
 from discord.ext import commands, tasks
 import typing
+import contextlib
 import dotenv
 import aiohttp
-version = "2.0.0"
+from version import version
 
 
 
@@ -19,10 +20,30 @@ intents.message_content = True
 intents.members = True
 
 
-# make the bot
-bot = commands.Bot(command_prefix = '$',intents=intents, activity=discord.Game(name='Play some music!'))
+# make the bot, launcher.py runs several of these with a share of the shards each
+shard_count = os.environ.get("TEMPO_SHARD_COUNT")
+if shard_count is None:
+    bot = commands.Bot(command_prefix = '$',intents=intents, activity=discord.Game(name='Play some music!'))
+    primary = True
+else:
+    shard_ids = [int(id) for id in os.environ["TEMPO_SHARD_IDS"].split(",")]
+    bot = commands.AutoShardedBot(command_prefix = '$',intents=intents, activity=discord.Game(name='Play some music!'), shard_count=int(shard_count), shard_ids=shard_ids)
+    # only one process sends update notifications
+    primary = 0 in shard_ids
 bot.settings = libTempo.load_settings(version)
 bot.backends = libTempo.import_backends("Backends/Music")
+# players are made the first time a guild needs one
+bot.players = libTempo.PlayerRegistry(lambda: libTempo.MusicPlayer(bot.backends, bot.settings["Voice"]))
+# platforms do not change while running, so their autocomplete is indexed once, in the order it is shown
+bot.platformindex = libTempo.AutocompleteIndex()
+for weight, platform in enumerate(reversed(["default", "all", *bot.backends])):
+    bot.platformindex.add(platform, platform, weight)
+
+def platformchoices(current: str, allowed):
+    return [
+        discord.app_commands.Choice(name=name, value=platform)
+        for name, platform in bot.platformindex.search(current) if platform in allowed
+    ]
 
 
 #update checks
@@ -44,13 +65,30 @@ async def updatecheck():
                     user = bot.get_user(app_info.owner.id)
                     await user.send(f"Update Available!\n{version} --> {newestversion}\n {resp['html_url']}\n\n To update, run `git pull`, then `conda env update -f environment.yml`.")
 
+# unload the voice models and drop players once nobody has used them for a while
+@tasks.loop(minutes=1)
+async def reclaim():
+    bot.players.reap(bot.settings["IdleTimeout"])
+    for backend in bot.backends.values():
+        # backends holding logins or connections open can let them go here
+        if hasattr(backend, "reclaim"):
+            backend.reclaim()
+    await asyncio.get_running_loop().run_in_executor(None, libTempo.models.reap)
+
+# the popular songs the /play autocomplete suggests
+@tasks.loop(minutes=10)
+async def refreshindex():
+    await libTempo.history.refresh()
+
 @bot.event
 async def on_ready():
-    await updatecheck()
+    if primary:
+        await updatecheck()
+    if not reclaim.is_running():
+        reclaim.start()
+    if not refreshindex.is_running():
+        refreshindex.start()
     print(f"{bot.user} is online.")
-    bot.players = {}
-    for guild in bot.guilds:
-        bot.players[guild.id] = libTempo.MusicPlayer(bot.backends, bot.settings["Voice"])
 
 @bot.command()
 @commands.is_owner()
@@ -92,39 +130,125 @@ async def play(interaction: discord.Interaction, song:str, platform:str = None):
     if not permissions.connect or not permissions.speak:
         await interaction.response.send_message("I do not have permission to play music in that voice channel.")
         return
-    userbackends = libTempo.getuserdata(interaction.user.id)
-    if platform != None and platform not in userbackends["keys"] and platform != "default":
+    userbackends = await libTempo.agetuserdata(interaction.user.id)
+    if platform != None and platform not in userbackends["keys"] and platform not in ["default", "all"]:
         await interaction.response.send_message("You are not authorized to use that platform.")
         return
     await interaction.response.send_message("Searching...")
+    # a song picked from the autocomplete is already known, no need to search for it
+    allowed = [backend for backend in await libTempo.agetuserbackends(interaction.user.id) if backend in bot.backends]
+    if platform not in [None, "default", "all"]:
+        allowed = [platform] if platform in allowed else []
+    hit = await libTempo.history.lookup(interaction.user.id, song, interaction.user, allowed)
+    if hit is not None:
+        await enqueue(interaction, hit)
+        return
+    if platform == "all":
+        # every platform the user can use at once, the menu starts with whichever answers first
+        keys = await libTempo.agetuserbackends(interaction.user.id)
+        await showresults(interaction, libTempo.federated_search(bot.backends, song, interaction.user, keys), platforms=True)
+        return
     if platform == None or platform == "default":
-        userbackend = libTempo.getuserbackend(interaction.user.id)
+        userbackend = await libTempo.agetuserbackend(interaction.user.id)
     else:
-        userbackend = [platform, libTempo.getuserkey(interaction.user.id, platform)]
-    result = await bot.backends[userbackend[0]].search(song, interaction.user, key=userbackend[1])
-    options = []
-    for i in range(len(result)):
-        options.append(discord.SelectOption(label=f'{i+1}) '+ result[i].title, description=f'By {result[i].author}', emoji='🎧'))
-    view = PlaySelectListView(options=options, interaction=interaction,results=result)
-    await interaction.edit_original_response(content="Choose a song", view=view)
+        userbackend = [platform, await libTempo.agetuserkey(interaction.user.id, platform)]
+    backend = bot.backends[userbackend[0]]
+    # isplaylist is optional, without it a backend cant tell playlist links from searches
+    if backend.type == 2 and hasattr(backend, "isplaylist") and backend.isplaylist(song):
+        await importplaylist(interaction, backend, song, userbackend[1])
+        return
+    # the user picked this platform, so it gets as long as it needs
+    await showresults(interaction, libTempo.federated_search(bot.backends, song, interaction.user, {userbackend[0]: userbackend[1]}, timeout=None))
 @play.autocomplete('platform')
 async def shuffle_autocomplete(
     interaction: discord.Interaction,
     current: str,
 ) -> typing.List[discord.app_commands.Choice[str]]:
-    platforms = list(bot.backends.keys())
-    platforms.insert(0, "default")
+    return platformchoices(current, ["default", "all", *bot.backends])
+@play.autocomplete('song')
+async def song_autocomplete(
+    interaction: discord.Interaction,
+    current: str,
+) -> typing.List[discord.app_commands.Choice[str]]:
+    # only the local indexes are used here, the backends are searched once the command is sent
+    suggestions = await libTempo.history.suggest(interaction.user.id, current)
     return [
-        discord.app_commands.Choice(name=platform, value=platform)
-        for platform in platforms if current.lower() in platform.lower()
+        discord.app_commands.Choice(name=name[:100], value=url)
+        for name, url in suggestions if len(url) <= 100
     ]
 
 
+async def importplaylist(interaction: discord.Interaction, backend, url: str, key):
+    # the first page starts playing while the rest of the playlist keeps loading into the queue
+    count = 0
+    player = bot.players[interaction.guild.id]
+    generation = player.generation
+    try:
+        async with contextlib.aclosing(backend.getplaylist(url, interaction.user, key=key)) as pages:
+            async for page in pages:
+                if len(page) == 0:
+                    continue
+                if player.generation != generation:
+                    # /stop was used while the playlist loaded, that stops the import too
+                    await interaction.edit_original_response(content=f"Stopped loading the playlist, {count} songs were queued.")
+                    return
+                # looked up for every page, the player may have finished and left, or been reclaimed, while this one loaded
+                if bot.players.get(interaction.guild.id) is not player:
+                    player = bot.players[interaction.guild.id]
+                    generation = player.generation
+                if player.vc is None:
+                    try:
+                        await player.join_channel(interaction.user.voice.channel)
+                    except:
+                        await interaction.edit_original_response(content="you are not currently in a voice channel.")
+                        return
+                player.add_songs(page)
+                if player.active == False:
+                    player.play()
+                count += len(page)
+                await interaction.edit_original_response(content=f"Loading playlist, {count} songs queued so far...")
+    except Exception as e:
+        print(f"Failed to import playlist {url}: {e}")
+        if count == 0:
+            await interaction.edit_original_response(content="Could not load that playlist.")
+            return
+    await interaction.edit_original_response(content=f"Added {count} songs to the queue.")
+
+
+def songoptions(results, platforms = False):
+    options = []
+    # a select menu holds at most 25 options
+    for i in range(min(len(results), 25)):
+        description = f'By {results[i].author}' + (f' on {results[i].backend}' if platforms else '')
+        options.append(discord.SelectOption(label=(f'{i+1}) '+ results[i].title)[:100], description=description[:100], emoji='🎧'))
+    return options
+
+async def showresults(interaction: discord.Interaction, searches, platforms = False):
+    # searches yields the results so far each time more arrive, the menu is shown on the first and updated after
+    view = None
+    async with contextlib.aclosing(searches):
+        async for results in searches:
+            if view is None:
+                view = PlaySelectListView(options=songoptions(results, platforms), interaction=interaction,results=results)
+            elif view.is_finished():
+                # a song was already picked
+                return
+            else:
+                view.update(songoptions(results, platforms), results)
+            await interaction.edit_original_response(content="Choose a song", view=view)
+    if view is None:
+        await interaction.edit_original_response(content="No results found.")
+
+
 #view class to select the correct song.
 class PlaySelectListView(discord.ui.View):
     def __init__(self, *, timeout = 180, options: dict, interaction: discord.Interaction,results: list):
         super().__init__(timeout=timeout)
-        self.add_item(PlaySelectSong(option=options, interaction=interaction,results=results))
+        self.select = PlaySelectSong(option=options, interaction=interaction,results=results)
+        self.add_item(self.select)
+    def update(self, options: list, results: list):
+        self.select.options = options
+        self.select.results = results
 
 class PlaySelectSong(discord.ui.Select):
     def __init__(self,option: dict, interaction: discord.Interaction, results: list):
@@ -135,30 +259,49 @@ class PlaySelectSong(discord.ui.Select):
         # ask for an option to be selected
         super().__init__(placeholder="Select an option",options=option)
     async def callback(self, interaction: discord.Interaction):
+        # resolving can take longer than discord waits for an answer
+        await interaction.response.defer()
+        # stops the menu being updated with later results
+        self.view.stop()
         selection = int(self.values[0].split(") ")[0])-1
-        option = self.results[selection]
-        if bot.players[interaction.guild.id].active == False:
-            try:
-                await bot.players[interaction.guild.id].join_channel(self.original_interaction.user.voice.channel) 
-            except:
-                await self.original_interaction.edit_original_response(content="you are not currently in a voice channel.", view=None)
-                return
-        bot.players[interaction.guild.id].add_song(option)
-        if len(bot.players[interaction.guild.id].playlist) == 1:
-            await self.original_interaction.edit_original_response(content=f"Now Playing {option.title}.", view=None)
-            bot.players[interaction.guild.id].play()
-        else:
-            await self.original_interaction.edit_original_response(content=f"{option.title} added to the queue.", view=None)
+        await enqueue(self.original_interaction, self.results[selection])
+
+async def enqueue(interaction: discord.Interaction, option: libTempo.Song):
+    # interaction is the /play command, its response is edited to say what happened
+    backend = bot.backends[option.backend]
+    if hasattr(backend, "resolve"):
+        # searches only return what the menu shows, get the rest for the song that was picked
+        try:
+            await backend.resolve(option)
+        except Exception:
+            await interaction.edit_original_response(content=f"Could not load {option.title}.", view=None)
+            return
+    player = bot.players[interaction.guild.id]
+    if player.active == False:
+        try:
+            await player.join_channel(interaction.user.voice.channel) 
+        except:
+            await interaction.edit_original_response(content="you are not currently in a voice channel.", view=None)
+            return
+    player.add_song(option)
+    if len(player.playlist) == 1:
+        await interaction.edit_original_response(content=f"Now Playing {option.title}.", view=None)
+        player.play()
+    else:
+        await interaction.edit_original_response(content=f"{option.title} added to the queue.", view=None)
+    # feeds the /play autocomplete
+    await libTempo.history.record(interaction.user.id, option)
 
 bot.tree.add_command(play)
 
 
 @discord.app_commands.command(name='stop', description='Stops the current session')
 async def stop(interaction: discord.Interaction):
-    if bot.players[interaction.guild.id].active == False:
+    player = bot.players.get(interaction.guild.id)
+    if player is None or player.active == False:
         await interaction.response.send_message("There is nothing to stop.")
         return
-    bot.players[interaction.guild.id].stop()
+    player.stop()
     await interaction.response.send_message("Session stopped.")
 
 bot.tree.add_command(stop)
@@ -166,43 +309,50 @@ bot.tree.add_command(stop)
 
 @discord.app_commands.command(name='pause', description='Pauses the current song')
 async def pause(interaction: discord.Interaction):
-    if bot.players[interaction.guild.id].active == False:
+    player = bot.players.get(interaction.guild.id)
+    if player is None or player.active == False:
         await interaction.response.send_message("There is nothing to pause.")
         return
-    bot.players[interaction.guild.id].pause()
-    await interaction.response.send_message(f"Paused {bot.players[interaction.guild.id].playlist.GetCurrentEntry().title}.")
+    player.pause()
+    await interaction.response.send_message(f"Paused {player.playlist.GetCurrentEntry().title}.")
 
 bot.tree.add_command(pause)
 
 @discord.app_commands.command(name='resume', description='Resumes the current song')
 async def resume(interaction: discord.Interaction):
-    if bot.players[interaction.guild.id].active == False:
+    player = bot.players.get(interaction.guild.id)
+    if player is None or player.active == False:
         await interaction.response.send_message("There is nothing to resume.")
         return
-    bot.players[interaction.guild.id].resume()
-    await interaction.response.send_message(f"Resumed {bot.players[interaction.guild.id].playlist.GetCurrentEntry().title}.")
+    player.resume()
+    await interaction.response.send_message(f"Resumed {player.playlist.GetCurrentEntry().title}.")
 
 bot.tree.add_command(resume)
 
 @discord.app_commands.command(name='skip', description='Skips the current song')
 async def skip(interaction: discord.Interaction):
-    if bot.players[interaction.guild.id].active == False:
+    player = bot.players.get(interaction.guild.id)
+    if player is None or player.active == False:
         await interaction.response.send_message("There is nothing to skip.")
         return
-    title = bot.players[interaction.guild.id].playlist.GetCurrentEntry().title
-    bot.players[interaction.guild.id].skip()
+    title = player.playlist.GetCurrentEntry().title
+    player.skip()
     await interaction.response.send_message(f"Skipped {title}.")
 
 bot.tree.add_command(skip)
 
 
+## Number of songs /queue lists, the rest are counted in a single line
+queue_shown = 20
+
 @discord.app_commands.command(name='queue', description='Shows the Queue')
 async def queue(interaction: discord.Interaction):
-    if len(bot.players[interaction.guild.id].playlist) == 0:
+    player = bot.players.get(interaction.guild.id)
+    if player is None or len(player.playlist) == 0:
         await interaction.response.send_message("There is no music playing.")
         return
     
-    entries = bot.players[interaction.guild.id].getQueue()
+    entries = player.getQueue()
     embed = discord.Embed(title="Current Song Queue", color=0x00ff00)
     
     # Calculate total duration
@@ -214,14 +364,16 @@ async def queue(interaction: discord.Interaction):
     total_minutes, total_seconds = divmod(total_duration, 60)
     total_duration_str = f"{total_minutes}:{total_seconds:02d}"
 
-    # Add song details to the embed
-    for index, (title, author, duration) in enumerate(entries):
+    # Add song details to the embed, an embed holds at most 25 fields so long queues are cut short
+    for index, (title, author, duration) in enumerate(entries[:queue_shown]):
         if index == 0:
             embed.add_field(name=f"**{index + 1}. {title} [Now Playing]**", value=f"By {author}.", inline=False)
         else:
             embed.add_field(name=f"**{index + 1}. {title}**", value=f" By {author}", inline=False)
-    embed.add_field(name="Shuffle", value='On' if bot.players[interaction.guild.id].playlist.shuffle != False else 'Off', inline=True)
-    embed.add_field(name="Loop", value=["Off","Queue","Song"][bot.players[interaction.guild.id].playlist.loop], inline=True)
+    if len(entries) > queue_shown:
+        embed.add_field(name=f"+{len(entries) - queue_shown} more", value="\u200b", inline=False)
+    embed.add_field(name="Shuffle", value='On' if player.playlist.shuffle != False else 'Off', inline=True)
+    embed.add_field(name="Loop", value=["Off","Queue","Song"][player.playlist.loop], inline=True)
 
     # Add total duration at the bottom
     embed.add_field(name="Total Duration", value=total_duration_str, inline=False)
@@ -259,6 +411,16 @@ async def shuffle_autocomplete(
     ]
 
 
+@discord.app_commands.command(name='crossfade', description='sets how many seconds songs overlap, 0 turns it off.')
+async def crossfade(interaction: discord.Interaction, seconds:float):
+    if seconds < 0 or seconds > 12:
+        await interaction.response.send_message("Crossfade must be between 0 and 12 seconds.")
+        return
+    bot.players[interaction.guild.id].mixer.set_crossfade(seconds)
+    await interaction.response.send_message(f"Crossfade {'set to ' + str(seconds) + ' seconds' if seconds else 'disabled'}.")
+bot.tree.add_command(crossfade)
+
+
 @discord.app_commands.command(name='auth', description='Authorizes user for a platform')
 async def auth(interaction: discord.Interaction, platform:str, username: str, key:str):
     if platform not in bot.backends:
@@ -268,18 +430,14 @@ async def auth(interaction: discord.Interaction, platform:str, username: str, ke
     if key == None:
         await interaction.response.send_message("Invalid credentials.", ephemeral=True)
         return
-    libTempo.setuserkey(interaction.user.id, platform, key)
+    await libTempo.asetuserkey(interaction.user.id, platform, key)
     await interaction.response.send_message(f"Authorized {platform} account.", ephemeral=True)
 @auth.autocomplete('platform')
 async def shuffle_autocomplete(
     interaction: discord.Interaction,
     current: str,
 ) -> typing.List[discord.app_commands.Choice[str]]:
-    platforms = list(bot.backends.keys())
-    return [
-        discord.app_commands.Choice(name=platform, value=platform)
-        for platform in platforms if current.lower() in platform.lower()
-    ]
+    return platformchoices(current, bot.backends)
 bot.tree.add_command(auth)
 
 
@@ -288,18 +446,14 @@ async def deauth(interaction: discord.Interaction, platform:str):
     if platform not in bot.backends:
         await interaction.response.send_message("Invalid platform.")
         return
-    libTempo.rmuserkey(interaction.user.id, platform)
+    await libTempo.armuserkey(interaction.user.id, platform)
     await interaction.response.send_message(f"Deauthorized {platform} account.", ephemeral=True)
 @deauth.autocomplete('platform')
 async def shuffle_autocomplete(
     interaction: discord.Interaction,
     current: str,
 ) -> typing.List[discord.app_commands.Choice[str]]:
-    platforms = list(bot.backends.keys())
-    return [
-        discord.app_commands.Choice(name=platform, value=platform)
-        for platform in platforms if current.lower() in platform.lower()
-    ]
+    return platformchoices(current, bot.backends)
 bot.tree.add_command(deauth)
 
 @discord.app_commands.command(name='setplatform', description='sets a users preferred platform')
@@ -307,7 +461,7 @@ async def setplatform(interaction: discord.Interaction, platform:str):
     if platform not in bot.backends and platform != "default":
         await interaction.response.send_message("Invalid platform.")
         return
-    set = libTempo.setuserplatform(interaction.user.id, platform)
+    set = await libTempo.asetuserplatform(interaction.user.id, platform)
     if set:
         await interaction.response.send_message(f"Set preferred platform to {platform}.")
     else:
@@ -317,12 +471,7 @@ async def shuffle_autocomplete(
     interaction: discord.Interaction,
     current: str,
 ) -> typing.List[discord.app_commands.Choice[str]]:
-    platforms = list(bot.backends.keys())
-    platforms.insert(0, "default")
-    return [
-        discord.app_commands.Choice(name=platform, value=platform)
-        for platform in platforms if current.lower() in platform.lower()
-    ]
+    return platformchoices(current, ["default", *bot.backends])
 bot.tree.add_command(setplatform)
 
 
@@ -350,13 +499,17 @@ async def setsetting(interaction: discord.Interaction, setting:str, value:str):
     try:
         if setting in ["Voice", "updateDM"]:
             value = bool(value)
+        if setting == "IdleTimeout":
+            value = int(value)
+            if value < 0:
+                raise ValueError
     except:
         await interaction.response.send_message("Invalid value.")
         return
     bot.settings[setting] = value
     settings = bot.settings
     settings[setting] = value
-    libTempo.saveuserdata(0, settings)
+    await libTempo.asaveuserdata(0, settings)
     await interaction.response.send_message(f"Set {setting} to {value}. A restart is required to apply changes.")
 @setsetting.autocomplete('setting')
 async def shuffle_autocomplete(
@@ -375,13 +528,14 @@ bot.tree.add_command(setsetting)
 
 @discord.app_commands.command(name='move', description='moves songs in the queue')
 async def move(interaction: discord.Interaction, start:int, end:int):
-    if bot.players[interaction.guild.id].active == False:
+    player = bot.players.get(interaction.guild.id)
+    if player is None or player.active == False:
         await interaction.response.send_message("There is no music playing.")
         return
-    if start < 1 or end < 1 or start > len(bot.players[interaction.guild.id].playlist) or end > len(bot.players[interaction.guild.id].playlist):
+    if start < 1 or end < 1 or start > len(player.playlist) or end > len(player.playlist):
         await interaction.response.send_message("Invalid position.")
         return
-    bot.players[interaction.guild.id].playlist.move(start-1, end-1)
+    player.playlist.move(start-1, end-1)
     await interaction.response.send_message(f"Moved song from position {start} to {end}.")   
 bot.tree.add_command(move)
 
@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import urllib.request
+import dotenv
+from version import version
+
+## Number of bot processes to run, 0 starts one per cpu core
+processes = 0
+
+## Number of shards to run, 0 uses the count discord recommends
+shards = 0
+
+## Seconds to wait before restarting a process that exited
+restart_delay = 10
+
+
+def gateway(token):
+    # discord recommends a shard count and says how many shards may connect at once
+    request = urllib.request.Request("https://discord.com/api/v10/gateway/bot", headers={
+        "Authorization": f"Bot {token}",
+        "User-Agent": f"DiscordBot (https://github.com/jumpers775/Tempo, {version})"
+    })
+    with urllib.request.urlopen(request) as resp:
+        data = json.loads(resp.read())
+    return data["shards"], data["session_start_limit"]["max_concurrency"]
+
+def spawn(shardcount, ids):
+    env = dict(os.environ)
+    env["TEMPO_SHARD_COUNT"] = str(shardcount)
+    env["TEMPO_SHARD_IDS"] = ",".join(str(id) for id in ids)
+    return subprocess.Popen([sys.executable, "bot.py"], env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+def main():
+    dotenv.load_dotenv()
+    try:
+        token = os.environ['token']
+    except:
+        token = input("no token provided, Please input it here: ")
+        with open('.env', 'w') as envfile:
+            envfile.write('token = '+ token)
+        os.environ['token'] = token
+
+    recommended, concurrency = gateway(token)
+    shardcount = shards or recommended
+    count = min(processes or os.cpu_count() or 1, shardcount)
+    # every process gets every count-th shard, so guilds spread evenly over them
+    groups = [list(range(i, shardcount, count)) for i in range(count)]
+    print(f"Starting {shardcount} shards in {count} processes.")
+
+    workers = []
+    for ids in groups:
+        workers.append(spawn(shardcount, ids))
+        # discord only lets max_concurrency shards identify every 5 seconds, across all processes
+        time.sleep(5 * len(ids) / concurrency)
+
+    try:
+        while True:
+            time.sleep(1)
+            for i, worker in enumerate(workers):
+                if worker.poll() is not None:
+                    print(f"Process for shards {groups[i]} exited with code {worker.returncode}, restarting.")
+                    time.sleep(restart_delay)
+                    workers[i] = spawn(shardcount, groups[i])
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+if __name__ == "__main__":
+    main()
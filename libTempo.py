@@ -5,22 +5,134 @@ import asyncio
 import sqlite3
 import discord
 import random
+import itertools
 import numpy as np
-from tts import generate
 from discord.ext import voice_recv
 import math
-from faster_whisper import WhisperModel
-import io
-import wave
-import array
-from collections import defaultdict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
+import time
+import copy
 import json
+import re
+import inspect
+import bisect
+import contextlib
+
+class Database:
+    """Keeps one long-lived WAL connection to an sqlite file, with a worker thread for running queries off the event loop."""
+    def __init__(self, path: str, tables: list = ()):
+        self.path = path
+        self.tables = tables # CREATE TABLE statements run on first connect
+        self._db = None
+        self._lock = threading.RLock()
+        # a single worker keeps writes ordered and off the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tempo-db")
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            for table in self.tables:
+                self._db.execute(table)
+            self._db.commit()
+        return self._db
+
+    async def run(self, fn, *args):
+        """Runs a database function on the database thread so the event loop never waits on disk."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+class UserStore(Database):
+    """The user database, with an LRU cache of decoded user records."""
+    def __init__(self, path: str = "tempo.db", cachesize: int = 1024):
+        super().__init__(path, ["CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, data TEXT)"])
+        self.cachesize = cachesize
+        self._version = None
+        self._cache = OrderedDict()
+
+    def _sync(self, db):
+        # data_version only moves when another connection commits, so a shard process sees
+        # writes made by the others and drops records it may have cached before them
+        version = db.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._version:
+            self._version = version
+            self._cache.clear()
+
+    def _remember(self, id, data):
+        self._cache[id] = data
+        self._cache.move_to_end(id)
+        while len(self._cache) > self.cachesize:
+            self._cache.popitem(last=False)
+
+    def get(self, id, default=None):
+        """Returns a copy of the users record, inserting default if the user does not exist yet."""
+        with self._lock:
+            db = self._connect()
+            self._sync(db)
+            if id in self._cache:
+                self._cache.move_to_end(id)
+                return copy.deepcopy(self._cache[id])
+            row = db.execute("SELECT data FROM users WHERE id=?", (id,)).fetchone()
+            if row is not None:
+                data = json.loads(row[0])
+            elif default is not None:
+                data = copy.deepcopy(default)
+                db.execute("INSERT OR IGNORE INTO users (id, data) VALUES (?, ?)", (id, json.dumps(data)))
+                db.commit()
+            else:
+                return None
+            self._remember(id, data)
+            return copy.deepcopy(data)
+
+    def save(self, id, data):
+        with self._lock:
+            db = self._connect()
+            db.execute("UPDATE users SET data=? WHERE id=?", (json.dumps(data), id))
+            db.commit()
+            # write-through, the cached copy must not alias the callers dict
+            self._remember(id, copy.deepcopy(data))
+
+    def invalidate(self, id=None):
+        with self._lock:
+            if id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(id, None)
+
+    def close(self):
+        with self._lock:
+            super().close()
+            self._cache.clear()
+
+store = UserStore()
+
+# caches and play history, written all the time by every shard process. They are kept out of tempo.db
+# because any commit there from another process makes the user store drop its whole cache
+shared = Database("tempo-shared.db", [
+    "CREATE TABLE IF NOT EXISTS cache (name TEXT, key TEXT, expires REAL, value TEXT, PRIMARY KEY (name, key))",
+    "CREATE TABLE IF NOT EXISTS plays (userid INTEGER, url TEXT, title TEXT, author TEXT, backend TEXT, length INTEGER, count INTEGER, last REAL, PRIMARY KEY (userid, url))"
+])
+
+DEFAULT_USER = {
+    "platform": "default",
+    "keys": {"youtube": None}
+}
 
 def load_settings(version):
     # create the database if it doesnt already exist
-    with sqlite3.connect("tempo.db") as db:
+    with store._lock:
+        db = store._connect()
         cursor = db.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, data TEXT)")
         cursor.execute("CREATE TABLE IF NOT EXISTS DBInfo (version TEXT)")
         # set version if databse was just created (first run)
         cursor.execute("SELECT * FROM DBInfo")
@@ -29,48 +141,49 @@ def load_settings(version):
         else:
             pass # handle version updates here
         db.commit()
-        default = {
-            "UpdateDM": True,
-            "Default": "youtube",
-            "Key": None,
-            "Voice": False
-        }
-        cursor.execute("INSERT OR IGNORE INTO users (id, data) VALUES (?, ?)", (0, json.dumps(default)))
-        rows = cursor.execute("SELECT * FROM users WHERE id=?", (0,)).fetchall()
-        return json.loads(rows[0][1])
+    default = {
+        "UpdateDM": True,
+        "Default": "youtube",
+        "Key": None,
+        "Voice": False,
+        "IdleTimeout": 300
+    }
+    settings = store.get(0, default)
+    # settings added since the database was created
+    for key, value in default.items():
+        settings.setdefault(key, value)
+    return settings
 
 
 def getuserbackend(id):
         userdata = getuserdata(id)
         platform = userdata["platform"]
-        key = userdata["keys"][userdata["platform"]]
+        key = userdata["keys"][userdata["platform"]] if platform != "default" else None
         if platform == "default":
-            settings = load_settings(None)
+            settings = store.get(0)
             platform = settings["Default"]
             key = settings["Key"]
         return platform, key
 
+def getuserbackends(id):
+    """Returns platform -> key for every backend the user can search, their own default first."""
+    platform, key = getuserbackend(id)
+    backends = {platform: key}
+    settings = store.get(0)
+    backends.setdefault(settings["Default"], settings["Key"])
+    for platform, key in getuserdata(id)["keys"].items():
+        # removed keys are left behind as None, platforms in DEFAULT_USER never needed one
+        if key is not None or platform in DEFAULT_USER["keys"]:
+            backends.setdefault(platform, key)
+    return backends
+
 
 
 def getuserdata(id):
-    with sqlite3.connect("tempo.db") as db:
-        cursor = db.cursor()
-        rows = cursor.execute("SELECT * FROM users WHERE id=?", (id,)).fetchall()
-        if rows:
-            return json.loads(rows[0][1])
-        else:
-            default = {
-                "platform": "default",
-                "keys": {"youtube": None}
-            }
-            cursor.execute("INSERT INTO users (id, data) VALUES (?, ?)", (id, json.dumps(default)))
-            return default
+    return store.get(id, DEFAULT_USER)
 
 def saveuserdata(id, data):
-    with sqlite3.connect("tempo.db") as db:
-        cursor = db.cursor()
-        cursor.execute("UPDATE users SET data=? WHERE id=?", (json.dumps(data), id))
-        db.commit()
+    store.save(id, data)
 
 def setuserplatform(id, platform):
     userdata = getuserdata(id)
@@ -96,6 +209,197 @@ def getuserkey(id, platform):
     userdata = getuserdata(id)
     return userdata["keys"][platform]
 
+# async versions of the above for use in command handlers
+async def agetuserdata(id):
+    return await store.run(getuserdata, id)
+
+async def asaveuserdata(id, data):
+    return await store.run(saveuserdata, id, data)
+
+async def agetuserbackend(id):
+    return await store.run(getuserbackend, id)
+
+async def agetuserbackends(id):
+    return await store.run(getuserbackends, id)
+
+async def asetuserplatform(id, platform):
+    return await store.run(setuserplatform, id, platform)
+
+async def asetuserkey(id, platform, key):
+    return await store.run(setuserkey, id, platform, key)
+
+async def armuserkey(id, platform):
+    return await store.run(rmuserkey, id, platform)
+
+async def agetuserkey(id, platform):
+    return await store.run(getuserkey, id, platform)
+
+
+
+class TTLCache:
+    """Thread safe LRU cache where every entry expires after its own time to live."""
+    def __init__(self, maxsize: int = 256, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    async def aget(self, key, default=None):
+        # same as get(), so callers can await either kind of cache
+        return self.get(key, default)
+
+
+class SharedTTLCache(TTLCache):
+    """TTLCache backed by a table in the shared database, so every shard process can reuse what the others fetched."""
+    _missing = object()
+    # get() only looks in this process, aget() also checks the table, on the database thread
+
+    def __init__(self, name: str, maxsize: int = 256, ttl: float = 300):
+        super().__init__(maxsize, ttl)
+        self.name = name
+
+    async def aget(self, key, default=None):
+        value = self.get(key, self._missing)
+        if value is not self._missing:
+            return value
+        row = await shared.run(self._read, json.dumps(key))
+        # expiry is wall clock time here, monotonic clocks are not shared between processes
+        if row is None or row[0] <= time.time():
+            return default
+        value = json.loads(row[1])
+        super().set(key, value, row[0] - time.time())
+        return value
+
+    def _read(self, key):
+        with shared._lock:
+            return shared._connect().execute("SELECT expires, value FROM cache WHERE name=? AND key=?", (self.name, key)).fetchone()
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        super().set(key, value, ttl)
+        # encoded on the database thread too, values are treated as read only once they are cached
+        shared._executor.submit(self._write, key, value, time.time() + ttl)
+
+    def _write(self, key, value, expires):
+        key, value = json.dumps(key), json.dumps(value, default=str)
+        with shared._lock:
+            db = shared._connect()
+            db.execute("INSERT OR REPLACE INTO cache (name, key, expires, value) VALUES (?, ?, ?, ?)", (self.name, key, expires, value))
+            if random.random() < 0.01:
+                db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+            db.commit()
+
+    def pop(self, key, default=None):
+        value = super().pop(key, default)
+        shared._executor.submit(self._delete, json.dumps(key))
+        return value
+
+    def _delete(self, key):
+        with shared._lock:
+            db = shared._connect()
+            db.execute("DELETE FROM cache WHERE name=? AND key=?", (self.name, key))
+            db.commit()
+
+# launcher.py sets this in every shard process it starts
+sharded = "TEMPO_SHARD_COUNT" in os.environ
+
+def Cache(name: str, maxsize: int = 256, ttl: float = 300):
+    """Returns a cache shared between shard processes when running under launcher.py, and a plain in-process one otherwise."""
+    if sharded:
+        return SharedTTLCache(name, maxsize, ttl)
+    return TTLCache(maxsize, ttl)
+
+
+class ModelRegistry:
+    """Loads models on first use, shares one instance per process and unloads them once they sit idle."""
+    def __init__(self, idle: float = 600):
+        self.idle = idle # seconds a model can go unused before reap() unloads it, None keeps models loaded
+        self._loaders = {}
+        self._models = {}
+        self._lastused = {}
+        self._locks = {}
+
+    def register(self, name: str, loader, unloader=None):
+        self._loaders[name] = (loader, unloader)
+        self._locks[name] = threading.Lock()
+
+    def get(self, name: str):
+        # the lock makes sure concurrent first uses only load the model once
+        with self._locks[name]:
+            if name not in self._models:
+                self._models[name] = self._loaders[name][0]()
+            self._lastused[name] = time.monotonic()
+            return self._models[name]
+
+    def loaded(self, name: str):
+        return name in self._models
+
+    def unload(self, name: str):
+        with self._locks[name]:
+            model = self._models.pop(name, None)
+            if model is not None and self._loaders[name][1] is not None:
+                self._loaders[name][1](model)
+
+    def reap(self):
+        if self.idle is None:
+            return
+        now = time.monotonic()
+        for name in list(self._models):
+            if now - self._lastused.get(name, now) > self.idle:
+                self.unload(name)
+
+def _loadtts():
+    import tts
+    tts.load()
+    return tts
+
+def _loadwhisper():
+    from faster_whisper import WhisperModel
+    model = "base" # hardcoded, should be configurable
+    # one worker per transcription thread, otherwise the threads take turns on a single one
+    return WhisperModel(model, device="auto", compute_type="int8", num_workers=transcriber.workers)
+
+models = ModelRegistry()
+models.register("tts", _loadtts, lambda tts: tts.unload())
+models.register("whisper", _loadwhisper)
+
+# synthesis is serialised, the TTS model is shared by every guild
+speechpool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tempo-tts")
 
 
 def import_backends(backends_folder: str):
@@ -124,58 +428,385 @@ def import_backends(backends_folder: str):
     return backends    
 
 
+## Seconds a federated search waits for a backend before leaving its results out
+search_timeout = 5
+
+## Seconds two tracks lengths can differ by and still count as the same song
+duplicate_length = 3
+
+def _normalise(text):
+    # "Song (Official Video)" and "song" are the same title, "Artist - Topic" and "ArtistVEVO" the same artist
+    text = re.sub(r"[\(\[].*?[\)\]]", " ", text.lower())
+    text = re.sub(r" - topic$|vevo\b|\bofficial\b", " ", text)
+    return " ".join(re.findall(r"\w+", text))
+
+def _sametrack(a, b):
+    # different uploads on one platform are separate choices, only the same song on two platforms is merged
+    if a.backend == b.backend or _normalise(a.title) != _normalise(b.title):
+        return False
+    authora, authorb = _normalise(a.author), _normalise(b.author)
+    if authora not in authorb and authorb not in authora:
+        return False
+    # unknown lengths are 0, they dont rule out a match
+    return not a.length or not b.length or abs(a.length - b.length) <= duplicate_length
+
+def mergeresults(results, new):
+    """Appends the songs in new that are not already in results, so songs shown earlier keep their place."""
+    merged = list(results)
+    for song in new:
+        if not any(_sametrack(song, existing) for existing in merged):
+            merged.append(song)
+    return merged
+
+async def searchsongs(backend, query: str, user, count: int = 5, key = None):
+    """Yields a backends search results one at a time, whether its search is an async generator or returns a list."""
+    results = backend.search(query, user, count=count, key=key)
+    if inspect.isasyncgen(results):
+        async with contextlib.aclosing(results):
+            async for song in results:
+                yield song
+    else:
+        # older backends return the whole list at once
+        for song in await results:
+            yield song
+
+async def federated_search(backends, query: str, user, keys: dict, count: int = 5, timeout: float = search_timeout):
+    """Searches every platform in keys at once, yielding the merged results each time more arrive. A timeout of None waits for every platform."""
+    found = asyncio.Queue()
+    async def search(platform):
+        try:
+            async with asyncio.timeout(timeout):
+                async for song in searchsongs(backends[platform], query, user, count=count, key=keys[platform]):
+                    found.put_nowait(song)
+        except Exception as e:
+            # a slow or broken platform just leaves its results out, or the rest of them
+            print(f"Search on {platform} failed: {e!r}")
+        finally:
+            found.put_nowait(None)
+    tasks = [asyncio.create_task(search(platform)) for platform in keys if platform in backends]
+    results = []
+    running = len(tasks)
+    try:
+        while running > 0:
+            new = [await found.get()]
+            # take everything else that is already waiting, so a platform answering all at once is one update
+            while not found.empty():
+                new.append(found.get_nowait())
+            running -= new.count(None)
+            new = [song for song in new if song is not None]
+            if len(new) > 0:
+                results = mergeresults(results, new)
+                yield results
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _trigrams(text):
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+class AutocompleteIndex:
+    """Prefix and trigram index over autocomplete choices, so a keystroke never scans or fetches every entry."""
+    def __init__(self):
+        self._names = [] # sorted (lowercase name, value), for prefix lookups
+        self._entries = {} # value -> [name, weight, data]
+        self._trigrams = {} # trigram -> values whose name contains it
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, name: str, value: str, weight: float = 1, data = None):
+        """Adds a choice, or sets the weight of one that is already indexed. Heavier choices are suggested first."""
+        if value in self._entries:
+            self._entries[value][1] = weight
+            return
+        key = name.lower()
+        bisect.insort(self._names, (key, value))
+        for gram in _trigrams(key):
+            self._trigrams.setdefault(gram, set()).add(value)
+        self._entries[value] = [name, weight, data]
+
+    def remove(self, value: str):
+        entry = self._entries.pop(value, None)
+        if entry is None:
+            return
+        key = entry[0].lower()
+        i = bisect.bisect_left(self._names, (key, value))
+        if i < len(self._names) and self._names[i] == (key, value):
+            del self._names[i]
+        for gram in _trigrams(key):
+            values = self._trigrams.get(gram)
+            if values is not None:
+                values.discard(value)
+                if not values:
+                    del self._trigrams[gram]
+
+    def trim(self, size: int):
+        """Removes the lightest choices until at most size are left."""
+        if len(self._entries) <= size:
+            return
+        values = sorted(self._entries, key=lambda value: self._entries[value][1])
+        for value in values[:len(self._entries) - size]:
+            self.remove(value)
+
+    def weight(self, value: str, default: float = 0):
+        entry = self._entries.get(value)
+        return default if entry is None else entry[1]
+
+    def get(self, value: str, default = None):
+        entry = self._entries.get(value)
+        return default if entry is None else entry[2]
+
+    def search(self, text: str, limit: int = 25):
+        """Returns (name, value) pairs, names starting with text first, then names sharing most of its trigrams."""
+        text = text.lower().strip()
+        if not text:
+            values = sorted(self._entries, key=lambda value: -self._entries[value][1])
+            return [(self._entries[value][0], value) for value in values[:limit]]
+        prefixed = []
+        i = bisect.bisect_left(self._names, (text,))
+        while i < len(self._names) and self._names[i][0].startswith(text):
+            prefixed.append(self._names[i][1])
+            i += 1
+        prefixed.sort(key=lambda value: -self._entries[value][1])
+        matches = prefixed[:limit]
+        grams = _trigrams(text)
+        if len(matches) < limit and grams:
+            scores = {}
+            for gram in grams:
+                for value in self._trigrams.get(gram, ()):
+                    scores[value] = scores.get(value, 0) + 1
+            # at least half the trigrams have to be there, so a typo still matches but one shared syllable does not
+            needed = max(1, len(grams) // 2)
+            seen = set(matches)
+            found = [value for value, score in scores.items() if score >= needed and value not in seen]
+            found.sort(key=lambda value: (-scores[value], -self._entries[value][1]))
+            matches += found[:limit - len(matches)]
+        return [(self._entries[value][0], value) for value in matches]
+
+
+class PlayHistory:
+    """Records what users play in the database and keeps autocomplete indexes of their recent plays and the most popular songs."""
+    def __init__(self, recent: int = 50, popular: int = 500):
+        self.recent = recent # songs indexed per user
+        self.popular = popular # songs in the shared popular index
+        self.popularindex = AutocompleteIndex()
+        self._users = TTLCache(maxsize=1024, ttl=600) # user id -> index of their recent plays
+
+    def _record(self, userid, song):
+        with shared._lock:
+            db = shared._connect()
+            db.execute("INSERT INTO plays (userid, url, title, author, backend, length, count, last) VALUES (?, ?, ?, ?, ?, ?, 1, ?) "
+                       "ON CONFLICT (userid, url) DO UPDATE SET count = count + 1, last = excluded.last",
+                       (userid, song.url, song.title, song.author, song.backend, song.length, time.time()))
+            db.commit()
+
+    def _loadrecent(self, userid):
+        with shared._lock:
+            return shared._connect().execute("SELECT title, author, backend, length, url, last FROM plays WHERE userid=? ORDER BY last DESC LIMIT ?", (userid, self.recent)).fetchall()
+
+    def _loadpopular(self):
+        with shared._lock:
+            return shared._connect().execute("SELECT title, author, backend, length, url, SUM(count) AS plays FROM plays GROUP BY url ORDER BY plays DESC LIMIT ?", (self.popular,)).fetchall()
+
+    def _build(self, rows):
+        index = AutocompleteIndex()
+        for title, author, backend, length, url, weight in rows:
+            index.add(f"{title} - {author}", url, weight, (title, author, backend, length, url))
+        return index
+
+    async def refresh(self):
+        """Rebuilds the popular index, which also picks up plays made by other shard processes."""
+        self.popularindex = self._build(await shared.run(self._loadpopular))
+
+    async def userindex(self, userid):
+        index = self._users.get(userid)
+        if index is None:
+            index = self._build(await shared.run(self._loadrecent, userid))
+            self._users.set(userid, index)
+        return index
+
+    async def record(self, userid, song):
+        await shared.run(self._record, userid, song)
+        # the indexes are only touched on the event loop, so autocomplete never sees one half updated
+        data = (song.title, song.author, song.backend, song.length, song.url)
+        index = self._users.get(userid)
+        if index is not None:
+            index.add(f"{song.title} - {song.author}", song.url, time.time(), data)
+            # kept to the same size a fresh load would have, the oldest play drops out
+            index.trim(self.recent)
+        self.popularindex.add(f"{song.title} - {song.author}", song.url, self.popularindex.weight(song.url) + 1, data)
+        self.popularindex.trim(self.popular)
+
+    async def suggest(self, userid, text: str, limit: int = 25):
+        """Returns (name, url) pairs for text, the users own recent plays ahead of popular songs."""
+        results = (await self.userindex(userid)).search(text, limit)
+        seen = {url for _, url in results}
+        for name, url in self.popularindex.search(text, limit):
+            if len(results) >= limit:
+                break
+            if url not in seen:
+                results.append((name, url))
+        return results
+
+    async def lookup(self, userid, url: str, user, backends):
+        """Returns the Song for a url that came from suggest(), or None if it is not indexed or not on one of backends."""
+        data = (await self.userindex(userid)).get(url) or self.popularindex.get(url)
+        # the popular index holds every users plays, a hit is only playable on a platform this user may use
+        if data is None or data[2] not in backends:
+            return None
+        title, author, backend, length, url = data
+        return Song(user, title, author, backend, length, url)
+
+history = PlayHistory()
+
+
 class Song:
-    def __init__(self, user, title, author, backend, length, url):
-        self.user = user
+    # slotted, and only holding the users id, as big queues keep thousands of these alive per guild
+    __slots__ = ("userid", "title", "author", "backend", "length", "url", "resolved")
+
+    def __init__(self, user, title, author, backend, length, url, resolved=True):
+        self.userid = user if user is None or isinstance(user, int) else user.id
         self.title = title
-        self.author = author
-        self.backend = backend
+        # the same few backends and artists repeat across a queue, share one copy of each
+        self.author = sys.intern(author) if isinstance(author, str) else author
+        self.backend = sys.intern(backend)
         self.length = length
         self.url = url
+        self.resolved = resolved # False when a search left out details that backend.resolve() fills in
+
+    @property
+    def user(self):
+        return None if self.userid is None else discord.Object(id=self.userid)
         
 class Playlist:
     def __init__(self, title:str, entries:list):
         self.title = title
-        self.entries = [[i,entry] for i,entry in enumerate(entries)]
+        self._counter = itertools.count() # insertion index for every song, never reused
+        self._songs = {} # insertion index -> song, kept in insertion order so unshuffling needs no sort
+        self._order = deque() # insertion indexes in play order, the current song first
+        for entry in entries:
+            self._append(entry)
         self.shuffle = False
         self.loop = 0 # 0 is off, 1 is full queue, 2 is song
+        self.onchange = None # called whenever the upcoming songs may have changed
+
+    def _changed(self):
+        if self.onchange is not None:
+            self.onchange()
+
+    def _append(self, entry):
+        index = next(self._counter)
+        self._songs[index] = entry
+        self._order.append(index)
+
+    @property
+    def entries(self):
+        return [[index, self._songs[index]] for index in self._order]
 
     def __len__(self):
-        return len(self.entries)
+        return len(self._order)
     
     def delete(self, index):
-        self.entries.pop(index)
+        del self._songs[self._order[index]]
+        del self._order[index]
+        self._changed()
 
     def add(self, entry):
-        self.entries.append([max([i[0] for i in self.entries])+1 if len(self.entries) > 0 else 0, entry])
+        self._append(entry)
+        self._changed()
+
+    def extend(self, entries):
+        for entry in entries:
+            self._append(entry)
+        self._changed()
 
     def move(self, index, newindex):
-        self.entries.insert(newindex, self.entries.pop(index))
+        song = self._order[index]
+        del self._order[index]
+        self._order.insert(newindex, song)
+        self._changed()
 
     def GetCurrentEntry(self):
-        return self.entries[0][1]
+        return self._songs[self._order[0]]
     
     def next(self):
+        if len(self._order) == 0 or self.loop == 2:
+            return
+        index = self._order.popleft()
         if self.loop == 1:
-            self.entries.append(self.entries[0])
-        if len(self.entries) > 0 and self.loop!=2:
-            self.entries.pop(0)
+            self._order.append(index)
+        else:
+            del self._songs[index]
 
     def getAll(self):
-        return [entry[1] for entry in self.entries]
+        return [self._songs[index] for index in self._order]
+    def peek(self, count:int = 1):
+        """Returns the next count songs that will play after the current one, following the loop mode."""
+        if len(self._order) == 0:
+            return []
+        if self.loop == 2:
+            return [self.GetCurrentEntry()] * count
+        if self.loop == 1:
+            # the queue wraps around, the current song comes back after the rest
+            return [self._songs[self._order[(i + 1) % len(self._order)]] for i in range(count)]
+        return [self._songs[index] for index in itertools.islice(self._order, 1, count + 1)]
     def SetShuffle(self, mode: bool):
-        if not self.shuffle and mode == True:
-            currentsong = self.entries.pop(0)
-            random.shuffle(self.entries)
-            self.entries.insert(0,currentsong)
-        if mode == False:
-            currentsong = self.entries.pop(0)
-            self.entries.sort()
-            self.entries.insert(0,currentsong)
+        if len(self._order) > 0:
+            current = self._order.popleft()
+            if not self.shuffle and mode == True:
+                order = list(self._order)
+                random.shuffle(order)
+                self._order = deque(order)
+            if mode == False:
+                # the songs dict is already in insertion order
+                self._order = deque(index for index in self._songs if index != current)
+            self._order.appendleft(current)
+        self.shuffle = mode
+        self._changed()
     def SetLoop(self, mode:int):
         if mode not in [0,1,2]:
             raise ValueError("Loop mode must be [0,1,2]")
         self.loop = mode
+        self._changed()
+
+class PlayerRegistry(dict):
+    """guild id -> MusicPlayer, players are only created when a guild first uses one and dropped once they sit idle."""
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+        self.settings = {} # guild id -> settings of a reaped player, given to the next one made for that guild
+
+    def __getitem__(self, guild):
+        player = super().__getitem__(guild)
+        # every command goes through here, so this is when the guild last used its player
+        player.idlesince = time.monotonic()
+        return player
+
+    def get(self, guild, default=None):
+        # for commands that only act on a player that already exists, they count as use too
+        player = super().get(guild)
+        if player is None:
+            return default
+        player.idlesince = time.monotonic()
+        return player
+
+    def __missing__(self, guild):
+        player = self.factory()
+        settings = self.settings.pop(guild, None)
+        if settings is not None:
+            player.restore(settings)
+        self[guild] = player
+        return player
+
+    def reap(self, timeout: float):
+        """Closes every player that has not been used or in a voice channel for timeout seconds."""
+        now = time.monotonic()
+        for guild, player in list(self.items()):
+            if not player.active and player.vc is None and player._joining == 0 and now - player.idlesince > timeout:
+                del self[guild]
+                self.settings[guild] = player.savesettings()
+                player.close()
 
 class MusicPlayer:
     def __init__(self, backends, voice:bool = False):
@@ -188,13 +819,23 @@ class MusicPlayer:
 
         self._voice = voice
         self._textassistant = TextAssistant() if self._voice else None  
-        self._sink = WhisperSink()
+        self._sink = WhisperSink() if self._voice else None
         self._commands = ["play", "resume", "pause", "stop"]
         self._is_listening = False
         self._results = []
-        self._skip = False
-        self._paused = False 
-        self._stop = False
+        self._voicetask = None
+        self.lookahead = 2 # how many upcoming songs to resolve ahead of time
+        self.playlist.onchange = self._refreshprefetch
+        # set from the voice clients after callback when the current track ends
+        self._trackdone = asyncio.Event()
+        self._loop = None
+        self._ended = False
+        self._advances = 0
+        self._prefetched = [] # [song, task] pairs in the order they will play
+        self._queued = None # the prefetch task whose stream is waiting in the mixer
+        self.idlesince = time.monotonic() # when the player was last used, for PlayerRegistry.reap()
+        self._joining = 0 # join_channel() calls in progress, reap() leaves the player alone during them
+        self.generation = 0 # bumped by stop(), so work started before it, like a playlist import, knows to give up
     async def listen(self):
         if self.vc != None :
             if self.active == False:
@@ -205,74 +846,171 @@ class MusicPlayer:
             raise RuntimeError("MusicPlayer must be bound to a vc to listen.")
     async def _listen(self):
         if self._voice:
+            self._sink.bind(asyncio.get_running_loop())
             self.vc.listen(self._sink)
+            if False: # voice commands are disabled for now, _voiceloop handles them once they are back
+                self._voicetask = asyncio.create_task(self._voiceloop())
+    async def _voiceloop(self):
+        while True:
+            text = await self._sink.get()
+            try:
+                await self._handlevoice(text)
+            except Exception as e:
+                print(f"Voice command failed: {e}")
+    def _after(self, error):
+        # runs on the audio thread, hand the wakeup back to the event loop
+        if error is not None:
+            print(f"Player error: {error}")
+        self._loop.call_soon_threadsafe(self._onended)
+    def _onended(self):
+        self._ended = True
+        self._trackdone.set()
+    def _onadvance(self):
+        # the mixer switched to the queued stream without stopping playback
+        self._advances += 1
+        self._trackdone.set()
+    async def _resolve(self, song):
+        return await self.backends[song.backend].getstream(song.url, song.userid)
+    def _discard(self, task):
+        def cleanup(task):
+            if not task.cancelled() and task.exception() is None:
+                task.result().cleanup()
+        if task.done():
+            cleanup(task)
+        else:
+            task.cancel()
+            task.add_done_callback(cleanup)
+    def _queuenext(self, task):
+        # give the mixer the next stream as soon as it is ready so the switch is gapless
+        if len(self._prefetched) == 0 or self._prefetched[0][1] is not task:
+            return
+        if self._queued is task or task.cancelled() or task.exception() is not None:
+            return
+        self._queued = task
+        self.mixer.set_next1(task.result(), self._prefetched[0][0].length or 0)
+    def _refreshprefetch(self):
+        if not self.active:
+            return
+        upcoming = self.playlist.peek(self.lookahead)
+        keep = 0
+        while keep < len(self._prefetched) and keep < len(upcoming) and self._prefetched[keep][0] is upcoming[keep]:
+            keep += 1
+        if keep == 0 and len(self._prefetched) > 0:
+            # the queued stream no longer plays next
+            if self.mixer.take_next1() is None and self._queued is not None:
+                # unless the audio thread already switched to it and _onadvance hasnt run yet, then it is
+                # the one playing, _play refreshes again once it has caught up with the advance
+                return
+            self._queued = None
+        for song, task in self._prefetched[keep:]:
+            self._discard(task)
+        self._prefetched = self._prefetched[:keep]
+        for song in upcoming[keep:]:
+            self._prefetched.append([song, asyncio.create_task(self._resolve(song))])
+        if len(self._prefetched) > 0 and self._queued is not self._prefetched[0][1]:
+            self._prefetched[0][1].add_done_callback(self._queuenext)
+    async def _getstream(self, song):
+        if len(self._prefetched) > 0 and self._prefetched[0][0] is song:
+            _, task = self._prefetched.pop(0)
+            # it may already be sitting in the mixer, we are about to play it directly
+            self.mixer.take_next1()
+            self._queued = None
+            return await task
+        return await self._resolve(song)
     async def _play(self):
         self.active = True
+        self._loop = asyncio.get_running_loop()
+        self.mixer.on_advance = lambda: self._loop.call_soon_threadsafe(self._onadvance)
         while len(self.playlist) > 0:
-            song = self.playlist.GetCurrentEntry()
-            stream = await self.backends[song.backend].getstream(song.url, song.user.id)
-            self.mixer.set_source1(stream)
-            self.vc.play(self.mixer)
-            while self.vc.is_playing() or self.mixer.is_paused():
-                if self._stop:
-                    self.mixer.stop()
-                    self._stop = False
-                if self._skip == True:
-                    self.mixer.stop()
-                    self._skip = False
-                if self._paused == True:
-                    if not self.mixer.is_paused():
-                        self.mixer.pause()
-                else:
-                    if self.mixer.is_paused():
-                        self.mixer.resume()
-                if self._voice and False: # disable this for now
-                    text = self._sink.getupdate()
-                    if text is not None:
-                        text = text.split(":")
-                        id = text[0]
-                        text = "".join(text[1:])
-                        command, output = self._textassistant.run(text)
-                        if command == None and output == None:
-                            speech = generate("Sorry, I didnt quite get that,") 
-                            source2 = discord.FFmpegPCMAudio(speech, pipe=True)
-                            self.mixer.set_source2(source2)
-                        if command == "play" and output != None:
-                            if not self._is_listening:
-                                self._results = self.backends["youtube"].search(output) # placeholder, look up users prefered backend + add User object
-                                self._sink.lock(id)
-                                speech = generate("which would you like to play. " + " ".join([f"{num}. {self._results[i].title} by {self._results[i].author}" for i in range(len(self._results))])) 
-                                source2 = discord.FFmpegPCMAudio(speech, pipe=True)
-                                self.mixer.set_source2(source2)
-                                self._is_listening = True
-                        else:
-                            num = self._commands.index(command)
-                            if num == 0 or num == 1:
-                                self.resume()
-                            if num == 2:
-                                self.pause()
-                            if num == 3:
-                                self.stop()
-                    if self._is_listening == True:
-                        update = self._sink.getupdate()
-                        if update != None:
-                            key = [i in update for i in ["one","two","three","four","five"]]
-                            if True in key:
-                                num = key.index(True)
-                                self.add_song(self._results[num])
-                                self._is_listening = False
-                await asyncio.sleep(0.1)
-            self.playlist.next()
+            if not self.vc.is_playing() and not self.vc.is_paused():
+                song = self.playlist.GetCurrentEntry()
+                try:
+                    stream = await self._getstream(song)
+                except Exception as e:
+                    print(f"Failed to load {song.title}: {e}")
+                    self.playlist.next()
+                    continue
+                if len(self.playlist) == 0 or self.playlist.GetCurrentEntry() is not song:
+                    # the queue changed while the stream was loading
+                    stream.cleanup()
+                    continue
+                self.mixer.set_source1(stream, song.length or 0)
+                self._ended = False
+                self._trackdone.clear()
+                self.vc.play(self.mixer, after=self._after)
+            self._refreshprefetch()
+            # sleeps until the track finishes, is skipped/stopped, or the mixer moves on to the next stream
+            await self._trackdone.wait()
+            self._trackdone.clear()
+            while self._advances > 0:
+                self._advances -= 1
+                self.playlist.next()
+                if len(self._prefetched) > 0:
+                    self._prefetched.pop(0)
+                self._queued = None
+            if self._ended:
+                self._ended = False
+                self.mixer.stop()
+                self.playlist.next()
+        for song, task in self._prefetched:
+            self._discard(task)
+        self._prefetched = []
+        self._queued = None
         await self.leave_channel()
         self.active = False
+        self.idlesince = time.monotonic()
+    async def _handlevoice(self, text):
+        text = text.split(":")
+        id = int(text[0]) # the sink compares against discord user ids
+        text = "".join(text[1:])
+        if self._is_listening == True:
+            key = [i in text for i in ["one","two","three","four","five"]]
+            if True in key:
+                num = key.index(True)
+                self.add_song(self._results[num])
+            # one answer either way, then everyone can talk to the assistant again
+            self._is_listening = False
+            self._sink.unlock()
+            return
+        command, output = self._textassistant.run(text)
+        if command == None and output == None:
+            self.speak("Sorry, I didnt quite get that.")
+        elif command == "play" and output != None:
+            self._results = [song async for song in searchsongs(self.backends["youtube"], output, None)] # placeholder, look up users prefered backend + add User object
+            self._sink.lock(id)
+            self.speak("Which would you like to play? " + " ".join([f"{num+1}. {self._results[num].title} by {self._results[num].author}." for num in range(len(self._results))]))
+            self._is_listening = True
+        else:
+            num = self._commands.index(command)
+            if num == 0 or num == 1:
+                self.resume()
+            if num == 2:
+                self.pause()
+            if num == 3:
+                self.stop()
+    def speak(self, text):
+        # the DJ voice plays over the music as soon as the first sentence is ready
+        self.mixer.set_source2(SpeechSource(text))
     async def join_channel(self, vc:discord.VoiceChannel):
-        self.vc = await vc.connect(cls=voice_recv.VoiceRecvClient)
-        await self.listen()
+        self._joining += 1
+        try:
+            self.vc = await vc.connect(cls=voice_recv.VoiceRecvClient)
+            await self.listen()
+        finally:
+            self._joining -= 1
     async def leave_channel(self):
+        if self._sink is not None:
+            self._sink.unlock()
+            self._is_listening = False
+        if self._voicetask is not None:
+            self._voicetask.cancel()
+            self._voicetask = None
         await self.vc.disconnect()
         self.vc = None
     def add_song(self, song:Song):
         self.playlist.add(song)
+    def add_songs(self, songs:list):
+        self.playlist.extend(songs)
     def play(self):
         if self.vc != None :
             if self.active == False:
@@ -283,99 +1021,364 @@ class MusicPlayer:
             raise RuntimeError("MusicPlayer must be bound to a vc to play.")
     def pause(self):
         if self.active:
-            self._paused = True
+            # the voice clients player thread blocks on an event while paused
+            self.vc.pause()
+            self.mixer.pause()
         else:
             raise RuntimeError("Nothing is playing.")
     def resume(self):
         if self.active:
-            self._paused = False
+            self.mixer.resume()
+            self.vc.resume()
         else:
             raise RuntimeError("Nothing is playing.")
     def stop(self):
+        self.generation += 1
         self.playlist = Playlist("queue", [])
-        self._stop = True
+        self.playlist.onchange = self._refreshprefetch
+        self._advances = 0
+        self._refreshprefetch()
+        if self.vc is not None:
+            self.vc.stop()
+    def savesettings(self):
+        # what the guild set up on this player, kept by PlayerRegistry when the player is reaped
+        return {"crossfade": self.mixer.crossfade, "loop": self.playlist.loop, "shuffle": self.playlist.shuffle}
+    def restore(self, settings):
+        self.mixer.set_crossfade(settings["crossfade"])
+        self.playlist.SetLoop(settings["loop"])
+        self.playlist.SetShuffle(settings["shuffle"])
+    def close(self):
+        # the player is being thrown away, give back the mixers streams and the voice capture buffers
+        self.mixer.stop()
+        if self._sink is not None:
+            self._sink.cleanup()
     def getQueue(self):
         entries = self.playlist.getAll()
         return [[entry.title, entry.author, entry.length] for entry in entries]
     def skip(self):
-        self._skip = True
+        # the mixer drops the current stream on its next read and moves on to the queued one if it is ready
+        if self.vc is not None and self.vc.is_paused():
+            self.resume()
+        self.mixer.skip()
         
 
 
+# 20ms of 48kHz stereo 16 bit audio, the frame size discord reads
+FRAME_SAMPLES = 960
+FRAME_BYTES = FRAME_SAMPLES * 2 * 2
+
+class Channel:
+    """A single source feeding the Mixer, with its own gain, pause state and fade envelope."""
+    def __init__(self, source: discord.AudioSource = None, gain: float = 1.0, fadein: float = 0.0, ducks: bool = False, persistent: bool = False):
+        self.source = source
+        self.gain = gain
+        self.paused = False
+        self.ducks = ducks # lowers every other channel while this one is playing
+        self.persistent = persistent # stays in the mixer, waiting for a new source, once its source runs out
+        self.level = 1.0 # fade envelope, 0 is silent
+        self.duckgain = 1.0
+        self._target = 1.0
+        self._step = 1.0
+        self._stopping = False
+        self.curve = None # precomputed per sample fade, used for crossfades
+        self._curvepos = 0
+        if fadein > 0:
+            self.fadein(fadein)
+
+    def fadein(self, seconds: float):
+        self.level = 0.0
+        self._fade(1.0, seconds)
+        self._stopping = False
+
+    def fadeout(self, seconds: float):
+        # the channel is removed from the mixer once it is silent
+        self._fade(0.0, seconds)
+        self._stopping = True
+
+    def _fade(self, target, seconds):
+        self._target = target
+        self._step = abs(target - self.level) * 0.02 / seconds if seconds > 0 else 1.0
+
+    def _stepenvelope(self):
+        start = self.level
+        if self._target > start:
+            self.level = min(self._target, start + self._step)
+        else:
+            self.level = max(self._target, start - self._step)
+        return start, self.level
+
+    def setcurve(self, curve):
+        self.curve = curve
+        self._curvepos = 0
+
+    def _reset(self):
+        self.source = None
+        self.level = 1.0
+        self._target = 1.0
+        self._stopping = False
+        self.curve = None
+
 class Mixer(discord.AudioSource):
-    def __init__(self, source1: discord.AudioSource = None, source2: discord.AudioSource = None):
-        self.source1 = source1
-        self.source2 = source2
+    def __init__(self, source1: discord.AudioSource = None, source2: discord.AudioSource = None, gain1: float = 1.0, gain2: float = 1.0, duck: float = 0.3, ducktime: float = 0.1, maxsources: int = 8, crossfade: float = 0.0):
+        # source1 is the music, source2 is the DJ voice which ducks everything else
+        self.music = Channel(source1, gain1, persistent=True)
+        self.voice = Channel(source2, gain2, ducks=True, persistent=True)
+        self.channels = [self.music, self.voice] # replaced, never mutated, so read() can iterate without locking
         self._paused = False
+        self._next1 = None
+        self._skip = False
+        self._lock = threading.Lock()
+        self.on_advance = None # called from the audio thread when source1 moves on to the queued source
+        self._length = 0 # length of source1 in frames, 0 if unknown
+        self._nextlength = 0
+        self._played = 0 # frames read from source1 so far
+        self.set_crossfade(crossfade)
 
-    def overlay_audio(self, audio1_bytes, audio2_bytes, sample_width=2, num_channels=2, sample_rate=48000, volume:int = 0.3):
-        # Number of samples per 20ms for stereo audio
-        num_samples = int(0.02 * sample_rate * num_channels)
-        
-        # Convert bytes-like objects to numpy arrays
-        audio1 = np.frombuffer(audio1_bytes, dtype=np.int16).reshape(-1, num_channels).copy().astype(float)
-        audio2 = np.frombuffer(audio2_bytes, dtype=np.int16).reshape(-1, num_channels)
+        self.duck = duck # how far other channels are lowered while a ducking channel plays, so you can hear the DJ
+        self.ducktime = ducktime # seconds the ducking takes to fade in or out
+        # buffers are allocated once and reused for every frame
+        self._allocate(maxsources)
+        self._mix = np.zeros((FRAME_SAMPLES, 2), dtype=np.float32)
+        self._out = np.zeros((FRAME_SAMPLES, 2), dtype=np.int16)
+        self._ramp = np.arange(1, FRAME_SAMPLES + 1, dtype=np.float32) / FRAME_SAMPLES
 
-        #lower audio so you can hear the DJ
-        audio1 *= volume
+    def _allocate(self, maxsources):
+        self._frames = np.zeros((maxsources, FRAME_SAMPLES, 2), dtype=np.float32)
+        self._gains = np.zeros((maxsources, FRAME_SAMPLES), dtype=np.float32)
 
-        # Ensure both audio samples have the same length
-        min_length = min(len(audio1), len(audio2))
-        audio1 = audio1[:min_length]
-        audio2 = audio2[:min_length]
-        
-        # Overlay the audio by summing the samples
-        combined_audio = audio1 + audio2
-        
-        # Prevent clipping by scaling the combined audio
-        max_val = np.iinfo(np.int16).max
-        min_val = np.iinfo(np.int16).min
-        combined_audio = np.clip(combined_audio, min_val, max_val)
-        
-        # Convert the combined audio back to bytes
-        combined_audio_bytes = combined_audio.astype(np.int16).tobytes()
-        
-        return combined_audio_bytes
+    source1 = property(lambda self: self.music.source, lambda self, source: setattr(self.music, "source", source))
+    source2 = property(lambda self: self.voice.source, lambda self, source: setattr(self.voice, "source", source))
+    gain1 = property(lambda self: self.music.gain, lambda self, gain: setattr(self.music, "gain", gain))
+    gain2 = property(lambda self: self.voice.gain, lambda self, gain: setattr(self.voice, "gain", gain))
 
+    def add_source(self, source: discord.AudioSource, gain: float = 1.0, fadein: float = 0.0, ducks: bool = False):
+        """Plays another source on top of everything else until it runs out, returns its Channel."""
+        channel = Channel(source, gain, fadein, ducks)
+        with self._lock:
+            self.channels = self.channels + [channel]
+            if len(self.channels) > len(self._frames):
+                self._allocate(len(self.channels) * 2)
+        return channel
 
-    def read(self):
-        if self.source1 is not None and self._paused == False:
-            a = self.source1.read()
+    def remove_source(self, channel: Channel):
+        with self._lock:
+            self.channels = [i for i in self.channels if i is not channel]
+        if channel.source is not None:
+            channel.source.cleanup()
+
+    def _finish(self, channel):
+        if channel.persistent:
+            if channel.source is not None:
+                channel.source.cleanup()
+            channel._reset()
+        else:
+            self.remove_source(channel)
+
+    def set_crossfade(self, seconds: float):
+        """Sets how long consecutive tracks overlap, 0 turns crossfading off."""
+        self.crossfade = seconds
+        samples = int(seconds * 48000)
+        self._crossfade = samples // FRAME_SAMPLES
+        if samples == 0:
+            self._fadeincurve = self._fadeoutcurve = None
+            return
+        # equal power curves, computed once here instead of every frame
+        t = np.linspace(0, np.pi / 2, samples, dtype=np.float32)
+        self._fadeincurve = np.sin(t)
+        self._fadeoutcurve = np.cos(t)
+        self._fadeincurve[-1] = 1.0
+        self._fadeoutcurve[-1] = 0.0
+
+    def _startcrossfade(self):
+        with self._lock:
+            nextsource, self._next1 = self._next1, None
+            if nextsource is None:
+                return
+            # the finishing track fades out on its own channel while the next one fades in on the music channel
+            tail = Channel(self.source1, self.music.gain)
+            tail.duckgain = self.music.duckgain
+            tail.setcurve(self._fadeoutcurve)
+            self.channels = self.channels + [tail]
+            if len(self.channels) > len(self._frames):
+                self._allocate(len(self.channels) * 2)
+        self.source1 = nextsource
+        self.music.setcurve(self._fadeincurve)
+        self._length, self._played = self._nextlength, 0
+        if self.on_advance is not None:
+            self.on_advance()
+
+    def _readsource1(self):
+        a = self.source1.read() if not self._skip else b''
+        if not a:
+            self._skip = False
+            with self._lock:
+                nextsource, self._next1 = self._next1, None
+            if self.source1 is not None:
+                self.source1.cleanup()
+            self.source1 = nextsource
+            self.music.curve = None
+            if nextsource is None:
+                return None
+            self._length, self._played = self._nextlength, 0
+            a = nextsource.read()
+            if self.on_advance is not None:
+                self.on_advance()
+        self._played += 1
+        return a
+
+    def _envelope(self, channel, ducked, row, n):
+        # per sample gain for this frame, ramping linearly from where the last frame ended
+        duckstep = (1.0 - self.duck) * 0.02 / max(self.ducktime, 0.02)
+        duckstart = channel.duckgain
+        if ducked:
+            channel.duckgain = max(self.duck, duckstart - duckstep)
         else:
-            a = None
-            
-        if self.source2 is not None:
-            b = self.source2.read()
+            channel.duckgain = min(1.0, duckstart + duckstep)
+        levelstart, levelend = channel._stepenvelope()
+        start = channel.gain * levelstart * duckstart
+        end = channel.gain * levelend * channel.duckgain
+        if start == end:
+            row[:n] = start
         else:
-            b = None
-        
-        if a and b:  
-            return self.overlay_audio(a, b)
-        elif a:  
-            return a
-        elif b:  
-            return b
-        else:  
+            np.multiply(self._ramp[:n], end - start, out=row[:n])
+            row[:n] += start
+        if channel.curve is not None:
+            curve = channel.curve[channel._curvepos:channel._curvepos + n]
+            row[:len(curve)] *= curve
+            row[len(curve):n] *= channel.curve[-1]
+            channel._curvepos += n
+            if channel._curvepos >= len(channel.curve):
+                if channel.curve[-1] == 0.0:
+                    channel.level = 0.0
+                    channel._stopping = True
+                channel.curve = None
+            return None, None
+        return start, end
+
+    def read(self):
+        if self._crossfade and self._length and self._next1 is not None and not self._paused and self._played >= self._length - self._crossfade:
+            self._startcrossfade()
+        channels = self.channels
+        ducking = any(channel.ducks and channel.source is not None and not channel.paused for channel in channels)
+        count = 0
+        length = 0
+        unity = None
+        for channel in channels:
+            if channel.source is None or channel.paused:
+                continue
+            data = self._readsource1() if channel is self.music else channel.source.read()
+            if not data:
+                if channel is not self.music:
+                    self._finish(channel)
+                continue
+            if count == len(self._frames):
+                break
+            frame = np.frombuffer(data, dtype=np.int16).reshape(-1, 2)
+            n = len(frame)
+            np.copyto(self._frames[count, :n], frame, casting="unsafe")
+            self._frames[count, n:] = 0
+            self._gains[count, n:] = 0
+            start, end = self._envelope(channel, ducking and not channel.ducks, self._gains[count], n)
+            unity = data if start == end == 1.0 else None
+            length = max(length, n)
+            count += 1
+            if channel._stopping and channel.level == 0.0:
+                self._finish(channel)
+
+        if count == 0:
             return b''
+        if count == 1 and unity is not None:
+            # a single source at full volume doesnt need mixing
+            return unity
+        # every channel is scaled by its envelope and summed in a single pass
+        mix = self._mix[:length]
+        np.einsum("ns,nsc->sc", self._gains[:count, :length], self._frames[:count, :length], out=mix)
+        # saturate instead of wrapping around
+        np.clip(mix, -32768, 32767, out=mix)
+        out = self._out[:length]
+        np.copyto(out, mix, casting="unsafe")
+        return out.tobytes()
     
     def pause(self):
         self._paused = True
+        self.music.paused = True
     
     def resume(self):
         self._paused = False
+        self.music.paused = False
     
     def stop(self):
+        # release the FFmpeg process of the finished track, and anything still fading out on top of it
+        if self.source1 is not None:
+            self.source1.cleanup()
         self.source1 = None
+        self.music.curve = None
+        for channel in self.channels:
+            if not channel.persistent:
+                self.remove_source(channel)
 
     def is_paused(self):
         return self._paused
 
-    def set_source1(self, new_source: discord.AudioSource):
-        # Set the new source1
+    def skip(self):
+        self._skip = True
+
+    def set_source1(self, new_source: discord.AudioSource, length: int = 0):
+        # Set the new source1, length is in seconds and only needed for crossfading
+        self._skip = False
+        self.music.curve = None
+        self._length, self._played = length * 50, 0
         self.source1 = new_source
+    def set_next1(self, new_source: discord.AudioSource, length: int = 0):
+        # queue a source to take over from source1 as soon as it runs out, or crossfade into it near the end
+        with self._lock:
+            self._next1 = new_source
+            self._nextlength = length * 50
+    def take_next1(self):
+        # remove the queued source, returns None if it was already picked up
+        with self._lock:
+            nextsource, self._next1 = self._next1, None
+        return nextsource
     def set_source2(self, new_source: discord.AudioSource):
-        # Set the new source1
-        self.source2 = new_source
+        # Set the new source2, the one it replaces is cut off and cleaned up
+        old, self.source2 = self.source2, new_source
+        if old is not None and old is not new_source:
+            old.cleanup()
+
+class SpeechSource(discord.AudioSource):
+    """Plays synthesised speech as it is generated, one sentence at a time, without going through FFmpeg."""
+    SILENCE = bytes(FRAME_BYTES)
+
+    def __init__(self, text: str):
+        self._frames = deque()
+        self._done = False
+        self._cancelled = False
+        speechpool.submit(self._synthesise, text)
+
+    def _synthesise(self, text):
+        try:
+            for pcm in models.get("tts").stream(text):
+                if self._cancelled:
+                    return
+                for i in range(0, len(pcm), FRAME_BYTES):
+                    frame = pcm[i:i + FRAME_BYTES]
+                    if len(frame) < FRAME_BYTES:
+                        frame += bytes(FRAME_BYTES - len(frame))
+                    self._frames.append(frame)
+        except Exception as e:
+            print(f"Speech synthesis failed: {e}")
+        finally:
+            self._done = True
+
+    def read(self):
+        if self._frames:
+            return self._frames.popleft()
+        # still synthesising the next sentence, keep the channel open
+        return b'' if self._done else self.SILENCE
+
+    def cleanup(self):
+        self._cancelled = True
+        self._frames.clear()
 
 class BytesAudioSource(discord.AudioSource):
     def __init__(self, byte_io):
@@ -392,15 +1395,222 @@ class BytesAudioSource(discord.AudioSource):
 
 
 
+def pcm_to_whisper(pcm) -> np.ndarray:
+    """Converts 48kHz stereo 16 bit PCM into the 16kHz mono float32 samples Whisper takes directly."""
+    # view the buffer as samples without copying it
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    frames = len(samples) // 6 * 3
+    # every 3 stereo frames at 48kHz become one sample at 16kHz, averaging them
+    # downmixes and low passes before decimating in a single pass
+    audio = samples[:frames * 2].reshape(-1, 3, 2).mean(axis=(1, 2), dtype=np.float32)
+    audio *= 1 / 32768
+    return audio
+
+class TranscriptionPool:
+    """Runs Whisper for every sink on a few worker threads fed by a bounded job queue."""
+    def __init__(self, workers: int = 2, maxjobs: int = 32, maxage: float = 10.0, batch: int = 4):
+        self.workers = workers
+        self.maxage = maxage # seconds after which a queued utterance is too stale to be worth transcribing
+        self.batch = batch # jobs a worker takes off the queue at once, transcribed one after another
+        self._jobs = queue.Queue(maxsize=maxjobs)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, audio, callback):
+        """Queues audio for transcription, callback is called with the text from a worker thread."""
+        self._start()
+        job = (time.monotonic(), audio, callback)
+        while True:
+            try:
+                self._jobs.put_nowait(job)
+                return
+            except queue.Full:
+                # under backpressure the oldest utterance is the least useful one
+                try:
+                    self._jobs.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name="tempo-whisper", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            jobs = [self._jobs.get()]
+            # take whatever else is already waiting so the model is fetched once per batch
+            while len(jobs) < self.batch:
+                try:
+                    jobs.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            model = models.get("whisper")
+            for submitted, audio, callback in jobs:
+                if time.monotonic() - submitted > self.maxage:
+                    continue
+                try:
+                    segments, info = model.transcribe(audio, beam_size=5)
+                    # segments are decoded lazily, joining them runs the model
+                    text = "".join([segment.text for segment in segments])
+                except Exception as e:
+                    print(f"Transcription failed: {e}")
+                    continue
+                callback(text)
+
+transcriber = TranscriptionPool()
+
+class VoiceActivity:
+    """Cheap energy based voice activity detection for a single user, with an adaptive noise floor."""
+    def __init__(self, threshold: float = 300.0, ratio: float = 3.0, hangover: int = 15, preroll: int = 5, minspeech: int = 10, rise: float = 0.001):
+        self.threshold = threshold # minimum RMS that can count as speech
+        self.ratio = ratio # how far above the noise floor speech has to be
+        self.rise = rise # how fast the noise floor creeps up per voiced packet, slow enough that speech ends first
+        self.hangover = hangover # silent packets (20ms each) before a segment ends
+        self.minspeech = minspeech # voiced packets a segment needs to be worth transcribing
+        self.noise = threshold
+        self.preroll = deque(maxlen=preroll) # audio from just before speech started, so the first word isnt clipped
+        self.active = False # inside a segment
+        self.speech = 0 # voiced packets in the current segment
+        self.trailing = 0 # samples of silence at the end of the current segment
+        self.lastheard = time.monotonic() # for dropping the detector once its user goes quiet, like their ring
+
+    def isvoiced(self, pcm) -> bool:
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        if len(samples) == 0:
+            return False
+        rms = math.sqrt(np.square(samples, dtype=np.float32).mean())
+        voiced = rms > max(self.threshold, self.noise * self.ratio)
+        if voiced:
+            # a floor that only followed silence could never climb past steady loud noise, which would then be speech forever
+            self.noise += self.rise * (rms - self.noise)
+        else:
+            # follow the background level quickly while nobody is talking
+            self.noise = 0.95 * self.noise + 0.05 * max(rms, 1.0)
+        return voiced
+
+    def reset(self):
+        self.active = False
+        self.speech = 0
+        self.trailing = 0
+        self.preroll.clear()
+
+class AudioRing:
+    """Fixed capacity buffer of 16kHz mono float32 audio that overwrites its oldest samples once full."""
+    def __init__(self, capacity: int):
+        self._data = np.zeros(capacity, dtype=np.float32)
+        self._start = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def extend(self, samples: np.ndarray):
+        capacity = len(self._data)
+        if len(samples) >= capacity:
+            self._data[:] = samples[-capacity:]
+            self._start, self._length = 0, capacity
+            return
+        end = (self._start + self._length) % capacity
+        first = min(len(samples), capacity - end)
+        self._data[end:end + first] = samples[:first]
+        self._data[:len(samples) - first] = samples[first:]
+        self._length += len(samples)
+        if self._length > capacity:
+            self._start = (self._start + self._length - capacity) % capacity
+            self._length = capacity
+
+    def truncate(self, count: int):
+        # drop the newest count samples
+        self._length = max(0, self._length - count)
+
+    def get(self) -> np.ndarray:
+        # the ring is reused straight away, so whatever is handed out has to be a copy
+        end = self._start + self._length
+        if end <= len(self._data):
+            return self._data[self._start:end].copy()
+        return np.concatenate((self._data[self._start:], self._data[:end - len(self._data)]))
+
+    def clear(self):
+        self._start = 0
+        self._length = 0
+
+class RingPool:
+    """Shares a fixed number of preallocated AudioRings between every user of every sink, so capture memory stays constant."""
+    def __init__(self, slots: int = 16, seconds: float = 10, idle: float = 60):
+        self.idle = idle # seconds after which an unused ring is taken back
+        self._free = [AudioRing(int(seconds * 16000)) for _ in range(slots)]
+        self._owners = OrderedDict() # key -> [ring, last used], least recently used first
+        self._lock = threading.Lock()
+
+    def _acquire(self, key) -> AudioRing:
+        # called with the lock held, so a ring is never evicted or cleared while someone is writing to it
+        now = time.monotonic()
+        entry = self._owners.get(key)
+        if entry is None:
+            for owner, (ring, lastused) in list(self._owners.items()):
+                if now - lastused > self.idle:
+                    del self._owners[owner]
+                    self._free.append(ring)
+            if len(self._free) == 0:
+                # every ring is busy, the least recently heard speaker loses theirs
+                _, (ring, _) = self._owners.popitem(last=False)
+                self._free.append(ring)
+            ring = self._free.pop()
+            ring.clear()
+            entry = self._owners[key] = [ring, now]
+        entry[1] = now
+        self._owners.move_to_end(key)
+        return entry[0]
+
+    def extend(self, key, *chunks) -> int:
+        """Appends audio to keys ring, taking a free one if it has none, and returns how many samples it holds."""
+        with self._lock:
+            ring = self._acquire(key)
+            for chunk in chunks:
+                ring.extend(chunk)
+            return len(ring)
+
+    def take(self, key, drop: int = 0):
+        """Releases keys ring and returns a copy of its audio without the newest drop samples, None if it had none."""
+        with self._lock:
+            entry = self._owners.pop(key, None)
+            if entry is None:
+                return None
+            ring = entry[0]
+            ring.truncate(drop)
+            audio = ring.get()
+            self._free.append(ring)
+            return audio
+
+    def release(self, key):
+        with self._lock:
+            entry = self._owners.pop(key, None)
+            if entry is not None:
+                self._free.append(entry[0])
+
+    def releaseall(self, owner):
+        with self._lock:
+            for key in [key for key in self._owners if key[0] == owner]:
+                self._free.append(self._owners.pop(key)[0])
+
+rings = RingPool()
+
 class WhisperSink(voice_recv.AudioSink):
     def __init__(self,triggerwords=None):
         super().__init__()
-        self.user_packets = defaultdict(lambda: array.array("B"))
-        model = "base" # hardcoded, should be configurable
-        self.whisper = WhisperModel(model, device="auto", compute_type="int8")
-        self.latest_text = None
+        self.vad = OrderedDict() # user id -> VoiceActivity, least recently heard first
+        self.maxlength = 5 # seconds a segment can run before it is transcribed anyway
         self.triggerwords = triggerwords or ["tempo","play","stop","pause"]
         self._lock = None
+        self._loop = None
+        self.results = None # asyncio.Queue of "userid:text", created by bind()
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        # results are handed to this loop from the transcription workers
+        self._loop = loop
+        self.results = asyncio.Queue()
     def wants_opus(self) -> bool:
         return False
     def write(self, user: discord.User | discord.Member | None, data: voice_recv.VoiceData):
@@ -412,51 +1622,103 @@ class WhisperSink(voice_recv.AudioSink):
         
 
         user_id = user.id
-        self.user_packets[user_id].extend(data.pcm)
-
-        speaking_length = len(self.user_packets[user_id]) / (48000 * 2 * 2)  # assuming PCM format with 48kHz, stereo, 16-bit audio
+        key = (id(self), user_id)
+        now = time.monotonic()
+        self._evict(now)
+        vad = self.vad.get(user_id)
+        if vad is None:
+            vad = self.vad[user_id] = VoiceActivity()
+        else:
+            self.vad.move_to_end(user_id)
+        vad.lastheard = now
+        voiced = vad.isvoiced(data.pcm)
+        audio = pcm_to_whisper(data.pcm)
+        # only voiced segments are kept, noise and music bleed never reach whisper
+        if voiced:
+            if not vad.active:
+                vad.active = True
+                length = rings.extend(key, *vad.preroll, audio)
+                vad.preroll.clear()
+            else:
+                length = rings.extend(key, audio)
+            vad.speech += 1
+            vad.trailing = 0
+        elif vad.active:
+            length = rings.extend(key, audio)
+            vad.trailing += len(audio)
+            if vad.trailing >= vad.hangover * len(audio):
+                self._flush(user_id)
+                return
+        else:
+            vad.preroll.append(audio)
+            return
 
-        if math.floor(speaking_length) == 5:
-            self._transcribe(user_id)
-            self.user_packets[user_id] = array.array("B")
-    def _transcribe(self, user_id):
+        if length >= self.maxlength * 16000:
+            self._flush(user_id)
+    def _evict(self, now):
+        # detectors are dropped like rings are, once their user has not been heard for rings.idle seconds
+        while len(self.vad) > 0:
+            user_id, vad = next(iter(self.vad.items()))
+            if now - vad.lastheard <= rings.idle:
+                break
+            self.forget(user_id)
+    def _flush(self, user_id):
+        # transcribe the segment without its trailing silence, if it had enough speech in it
+        vad = self.vad.get(user_id)
+        audio = rings.take((id(self), user_id), 0 if vad is None else vad.trailing)
+        if vad is None:
+            return
+        speech = vad.speech
+        # only the segment ends, the detector keeps the noise floor it learned for the next one
+        vad.reset()
+        if audio is None:
+            return
         if self._lock != None and self._lock != user_id:
+            # someone else has the assistant, what this user said meanwhile is not meant for it
             return
-        pcm_data = self.user_packets[user_id]
-        audio_data = np.array(pcm_data, dtype="B")
-        audio_buffer = io.BytesIO()
-        with wave.open(audio_buffer, "wb") as wav_file:
-            wav_file.setnchannels(2)  # Stereo
-            wav_file.setsampwidth(2)  # 16-bit
-            wav_file.setframerate(48000)  # 48 kHz
-            wav_file.writeframes(audio_data.tobytes())
-        audio_buffer.seek(0)
-        segments, info = self.whisper.transcribe(audio_buffer, beam_size=5)
-        text = "".join([segment.text for segment in segments])
+        if speech >= vad.minspeech:
+            self._transcribe(user_id, audio)
+    def _transcribe(self, user_id, audio):
+        if len(audio) == 0:
+            return
+        transcriber.submit(audio, lambda text: self._deliver(user_id, text))
+    def _deliver(self, user_id, text):
+        # runs on a transcription worker
         if True in [i in text.lower() for i in self.triggerwords] or self._lock != None:
             if text.startswith(self.triggerwords[0]):
                 text = text[len(self.triggerwords[0])+1:] # get rid of tempo wake word as it isnt a command
-            self.latest_text = str(user_id) + ":" + text
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self.results.put_nowait, str(user_id) + ":" + text)
+    async def get(self):
+        """Waits for the next transcribed command."""
+        return await self.results.get()
     def getupdate(self):
-        if self.latest_text != None:
-            text = self.latest_text
-            self.latest_text = None
-            return text
+        if self.results is not None and not self.results.empty():
+            return self.results.get_nowait()
     def lock(self, id):
         self._lock = id
     def unlock(self):
         self._lock = None
+    def forget(self, user_id):
+        # drop everything held for a user who left
+        rings.release((id(self), user_id))
+        self.vad.pop(user_id, None)
     def cleanup(self):
-        return
+        rings.releaseall(id(self))
+        self.vad.clear()
 
     @voice_recv.AudioSink.listener()
     def on_voice_member_speaking_start(self, member: discord.Member):
-        self.user_packets[member.id] = array.array("B")
+        if member.id in self.vad:
+            self.vad[member.id].reset()
 
     @voice_recv.AudioSink.listener()
     def on_voice_member_speaking_stop(self, member: discord.Member):
-        self._transcribe(member.id)
-        self.user_packets[member.id] = array.array("B")
+        self._flush(member.id)
+
+    @voice_recv.AudioSink.listener()
+    def on_voice_member_disconnect(self, member: discord.Member, ssrc: int):
+        self.forget(member.id)
 
 
 
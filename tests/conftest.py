@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the bot is a set of flat modules run from the repository root, backends are imported by name from their folder
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.append(os.path.join(root, "Backends", "Music"))
@@ -0,0 +1,111 @@
+import time
+import numpy as np
+import libTempo
+
+
+def test_pcm_to_whisper_downmixes_and_decimates():
+    # 48kHz stereo, left at 0.5 and right at 0, becomes 16kHz mono at 0.25
+    pcm = np.zeros((960, 2), dtype=np.int16)
+    pcm[:, 0] = 16384
+    audio = libTempo.pcm_to_whisper(pcm.tobytes())
+    assert audio.dtype == np.float32
+    assert len(audio) == 320
+    assert np.allclose(audio, 0.25)
+
+def test_pcm_to_whisper_drops_a_partial_frame():
+    pcm = np.zeros((961, 2), dtype=np.int16)
+    assert len(libTempo.pcm_to_whisper(pcm.tobytes())) == 320
+def test_ring_keeps_the_newest_samples():
+    ring = libTempo.AudioRing(5)
+    ring.extend(np.arange(3, dtype=np.float32))
+    ring.extend(np.arange(3, 7, dtype=np.float32))
+    assert len(ring) == 5
+    assert ring.get().tolist() == [2, 3, 4, 5, 6]
+    ring.extend(np.arange(10, dtype=np.float32))
+    assert ring.get().tolist() == [5, 6, 7, 8, 9]
+
+def test_ring_truncate_drops_the_newest():
+    ring = libTempo.AudioRing(4)
+    ring.extend(np.arange(6, dtype=np.float32))
+    ring.truncate(1)
+    assert ring.get().tolist() == [2, 3, 4]
+    ring.clear()
+    assert len(ring) == 0
+
+def test_pool_take_returns_and_frees_the_ring():
+    pool = libTempo.RingPool(slots=1, seconds=1)
+    assert pool.extend(("sink", 1), np.ones(10, dtype=np.float32), np.ones(5, dtype=np.float32)) == 15
+    audio = pool.take(("sink", 1), drop=5)
+    assert len(audio) == 10
+    assert pool.take(("sink", 1)) is None
+    # the only ring is free again, and starts empty
+    assert pool.extend(("sink", 2), np.ones(3, dtype=np.float32)) == 3
+
+def test_pool_gives_the_least_recent_speakers_ring_away():
+    pool = libTempo.RingPool(slots=2, seconds=1)
+    pool.extend(("sink", 1), np.ones(4, dtype=np.float32))
+    pool.extend(("sink", 2), np.ones(4, dtype=np.float32))
+    pool.extend(("sink", 1), np.ones(4, dtype=np.float32))
+    pool.extend(("sink", 3), np.ones(4, dtype=np.float32))
+    assert pool.take(("sink", 2)) is None
+    assert len(pool.take(("sink", 1))) == 8
+
+def test_pool_releaseall_frees_one_owners_rings():
+    pool = libTempo.RingPool(slots=2, seconds=1)
+    pool.extend(("a", 1), np.ones(4, dtype=np.float32))
+    pool.extend(("b", 1), np.ones(4, dtype=np.float32))
+    pool.releaseall("a")
+    assert pool.take(("a", 1)) is None
+    assert len(pool.take(("b", 1))) == 4
+
+
+class Member:
+    def __init__(self, id):
+        self.id = id
+
+class Data:
+    def __init__(self, pcm):
+        self.packet = None
+        self.pcm = pcm
+
+def speech(level, count):
+    return [Data(np.full((960, 2), level, dtype=np.int16).tobytes()) for _ in range(count)]
+
+def sink(monkeypatch):
+    sent = []
+    monkeypatch.setattr(libTempo.transcriber, "submit", lambda audio, callback: sent.append(audio))
+    return libTempo.WhisperSink(), sent
+
+def test_sink_keeps_the_detector_between_segments(monkeypatch):
+    whisper, sent = sink(monkeypatch)
+    user = Member(1)
+    for data in speech(20, 50) + speech(5000, 20) + speech(20, 20):
+        whisper.write(user, data)
+    assert len(sent) == 1
+    vad = whisper.vad[1]
+    assert not vad.active and vad.speech == 0
+    # the floor learned before the utterance is still there for the next one
+    assert vad.noise < 300
+    whisper.cleanup()
+
+def test_locked_out_speech_is_dropped(monkeypatch):
+    whisper, sent = sink(monkeypatch)
+    whisper.lock(2)
+    for data in speech(5000, 20) + speech(0, 20):
+        whisper.write(Member(1), data)
+    assert sent == []
+    assert libTempo.rings.take((id(whisper), 1)) is None
+    whisper.cleanup()
+
+def test_quiet_users_detectors_are_dropped(monkeypatch):
+    whisper, sent = sink(monkeypatch)
+    monkeypatch.setattr(libTempo.rings, "idle", 0.01)
+    for data in speech(5000, 3):
+        whisper.write(Member(1), data)
+    time.sleep(0.02)
+    whisper.write(Member(2), speech(5000, 1)[0])
+    assert list(whisper.vad) == [2]
+    assert libTempo.rings.take((id(whisper), 1)) is None
+    whisper.on_voice_member_disconnect(Member(2), 0)
+    assert len(whisper.vad) == 0
+    assert libTempo.rings.take((id(whisper), 2)) is None
@@ -0,0 +1,29 @@
+import time
+import libTempo
+
+
+def test_ttlcache_expires_entries():
+    cache = libTempo.TTLCache(maxsize=4, ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=10)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+
+def test_ttlcache_drops_the_least_recently_used():
+    cache = libTempo.TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+def test_ttlcache_ignores_expired_sets_and_pops():
+    cache = libTempo.TTLCache()
+    cache.set("a", 1, ttl=0)
+    assert len(cache) == 0
+    cache.set("b", 2)
+    assert cache.pop("b") == 2
+    assert cache.pop("b", "gone") == "gone"
@@ -0,0 +1,76 @@
+import asyncio
+import libTempo
+
+
+def index(names):
+    index = libTempo.AutocompleteIndex()
+    for weight, name in enumerate(names):
+        index.add(name, name.lower(), weight, name)
+    return index
+
+def test_prefix_matches_come_first_heaviest_first():
+    found = index(["Yellow Submarine", "Yesterday", "Hey Jude", "Yellow"]).search("yel")
+    assert [value for _, value in found] == ["yellow", "yellow submarine"]
+
+def test_typos_still_match_on_trigrams():
+    found = index(["Bohemian Rhapsody", "Hey Jude"]).search("bohemain rhapsody")
+    assert [value for _, value in found] == ["bohemian rhapsody"]
+
+def test_empty_text_lists_the_heaviest():
+    found = index(["a song", "b song", "c song"]).search("", limit=2)
+    assert [value for _, value in found] == ["c song", "b song"]
+
+def test_add_again_only_changes_the_weight():
+    idx = index(["Song"])
+    idx.add("Song", "song", 5)
+    assert len(idx) == 1 and idx.weight("song") == 5
+    assert idx.get("song") == "Song"
+
+def test_remove_and_trim():
+    idx = index(["one song", "two song", "three song", "four song"])
+    idx.remove("two song")
+    assert idx.get("two song") is None
+    assert "two song" not in [value for _, value in idx.search("two song")]
+    idx.trim(2)
+    assert sorted(value for _, value in idx.search("song")) == ["four song", "three song"]
+    assert idx.search("one") == []
+
+
+def history(tmp_path, monkeypatch, **kwargs):
+    monkeypatch.setattr(libTempo, "shared", libTempo.Database(str(tmp_path / "shared.db"), libTempo.shared.tables))
+    return libTempo.PlayHistory(**kwargs)
+
+def song(title, backend, url):
+    return libTempo.Song(1, title, "Artist", backend, 200, url)
+
+def test_suggestions_come_from_the_users_plays_then_popular(tmp_path, monkeypatch):
+    plays = history(tmp_path, monkeypatch)
+    async def run():
+        await plays.userindex(1)
+        await plays.record(1, song("Mine", "youtube", "a"))
+        await plays.record(2, song("Theirs", "youtube", "b"))
+        return await plays.suggest(1, "")
+    assert [url for _, url in asyncio.run(run())] == ["a", "b"]
+
+def test_lookup_only_returns_hits_on_allowed_backends(tmp_path, monkeypatch):
+    plays = history(tmp_path, monkeypatch)
+    async def run():
+        # someone else played it on spotify, it ends up in the popular index
+        await plays.record(2, song("Theirs", "spotify", "spotify:track:1"))
+        return (await plays.lookup(1, "spotify:track:1", None, ["youtube"]),
+                await plays.lookup(1, "spotify:track:1", None, ["youtube", "spotify"]),
+                await plays.lookup(1, "missing", None, ["youtube", "spotify"]))
+    denied, allowed, missing = asyncio.run(run())
+    assert denied is None and missing is None
+    assert allowed.backend == "spotify" and allowed.title == "Theirs"
+
+def test_indexes_are_trimmed_as_plays_are_recorded(tmp_path, monkeypatch):
+    plays = history(tmp_path, monkeypatch, recent=2, popular=3)
+    async def run():
+        await plays.userindex(1)
+        for i in range(5):
+            await plays.record(1, song(f"Song {i}", "youtube", str(i)))
+        return await plays.userindex(1)
+    index = asyncio.run(run())
+    assert len(index) == 2 and len(plays.popularindex) == 3
+    assert sorted(url for _, url in index.search("")) == ["3", "4"]
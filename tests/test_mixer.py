@@ -0,0 +1,151 @@
+import numpy as np
+import libTempo
+
+FRAME = libTempo.FRAME_SAMPLES
+
+
+class Tone:
+    # a source playing a constant sample value for a number of 20ms frames
+    def __init__(self, value, frames):
+        self.value = value
+        self.frames = frames
+        self.cleaned = False
+
+    def read(self):
+        if self.frames <= 0:
+            return b''
+        self.frames -= 1
+        return np.full((FRAME, 2), self.value, dtype=np.int16).tobytes()
+
+    def cleanup(self):
+        self.cleaned = True
+
+def frame(data):
+    return np.frombuffer(data, dtype=np.int16).reshape(-1, 2)
+
+def test_single_source_passes_through():
+    source = Tone(1000, 2)
+    mixer = libTempo.Mixer(source)
+    assert (frame(mixer.read()) == 1000).all()
+    assert (frame(mixer.read()) == 1000).all()
+    assert mixer.read() == b''
+    assert source.cleaned
+
+def test_voice_ducks_the_music():
+    mixer = libTempo.Mixer(Tone(10000, 100), Tone(1000, 100), duck=0.3, ducktime=0.1)
+    first = frame(mixer.read())
+    # the duck ramps in over the frame instead of jumping
+    assert first[0, 0] > first[-1, 0]
+    for _ in range(10):
+        out = frame(mixer.read())
+    # once the duck has settled the music is at 30% with the voice on top
+    assert abs(int(out[-1, 0]) - (3000 + 1000)) <= 1
+
+def test_music_comes_back_after_the_voice():
+    mixer = libTempo.Mixer(Tone(10000, 100), Tone(1000, 2))
+    for _ in range(20):
+        out = frame(mixer.read())
+    assert (out == 10000).all()
+
+def test_mixing_saturates():
+    mixer = libTempo.Mixer(Tone(30000, 5), Tone(30000, 5), duck=1.0)
+    assert (frame(mixer.read()) == 32767).all()
+
+def test_finished_sources_are_removed():
+    extra = Tone(500, 1)
+    mixer = libTempo.Mixer(Tone(1000, 10))
+    channel = mixer.add_source(extra)
+    assert channel in mixer.channels
+    mixer.read()
+    mixer.read()
+    assert extra.cleaned
+    assert len(mixer.channels) == 2
+
+def test_many_sources_are_summed():
+    mixer = libTempo.Mixer(maxsources=2)
+    for _ in range(5):
+        mixer.add_source(Tone(100, 5))
+    assert (frame(mixer.read()) == 500).all()
+
+def test_channel_gain_and_fadein():
+    mixer = libTempo.Mixer()
+    mixer.add_source(Tone(10000, 100), gain=0.5, fadein=0.1)
+    first = frame(mixer.read())
+    assert first[0, 0] < first[-1, 0] <= 5000
+    for _ in range(10):
+        out = frame(mixer.read())
+    assert (out == 5000).all()
+
+def test_fadeout_removes_the_channel_once_silent():
+    source = Tone(10000, 100)
+    mixer = libTempo.Mixer()
+    channel = mixer.add_source(source)
+    channel.fadeout(0.1)
+    for _ in range(10):
+        mixer.read()
+    assert source.cleaned and channel not in mixer.channels
+
+def test_pause_silences_the_music():
+    mixer = libTempo.Mixer(Tone(1000, 10))
+    mixer.pause()
+    assert mixer.read() == b''
+    mixer.resume()
+    assert (frame(mixer.read()) == 1000).all()
+
+def test_crossfade_overlaps_the_tracks():
+    # one second tracks with a half second crossfade
+    first, second = Tone(10000, 50), Tone(20000, 50)
+    mixer = libTempo.Mixer(crossfade=0.5)
+    mixer.set_source1(first, length=1)
+    mixer.set_next1(second, length=1)
+    outs = [frame(mixer.read()) for _ in range(75)]
+    assert (outs[0] == 10000).all()
+    start = 50 - mixer._crossfade
+    # the fade is equal power, the start is all the first track and the end all the second
+    assert abs(int(outs[start][0, 0]) - 10000) < 100
+    middle = outs[start + mixer._crossfade // 2][0, 0]
+    assert 10000 < middle < 10000 * 0.8 + 20000 * 0.8
+    assert (outs[-1] == 20000).all()
+    assert first.cleaned
+    assert len(mixer.channels) == 2
+
+def test_no_crossfade_without_a_known_length():
+    first, second = Tone(10000, 50), Tone(20000, 50)
+    mixer = libTempo.Mixer(crossfade=0.5)
+    mixer.set_source1(first)
+    mixer.set_next1(second)
+    outs = [frame(mixer.read()) for _ in range(51)]
+    assert (outs[49] == 10000).all() and (outs[50] == 20000).all()
+
+def test_crossfade_can_be_turned_off():
+    mixer = libTempo.Mixer(crossfade=2)
+    assert mixer._crossfade == 100
+    mixer.set_crossfade(0)
+    assert mixer.crossfade == 0 and mixer._crossfade == 0
+
+def test_set_source2_cleans_up_the_old_source():
+    old, new = Tone(1000, 10), Tone(2000, 10)
+    mixer = libTempo.Mixer(source2=old)
+    mixer.set_source2(new)
+    assert old.cleaned and not new.cleaned
+    mixer.set_source2(new)
+    assert not new.cleaned
+
+def test_queued_source_takes_over():
+    first, second = Tone(1000, 1), Tone(2000, 1)
+    advanced = []
+    mixer = libTempo.Mixer(first)
+    mixer.on_advance = lambda: advanced.append(1)
+    mixer.set_next1(second)
+    assert (frame(mixer.read()) == 1000).all()
+    assert (frame(mixer.read()) == 2000).all()
+    assert first.cleaned and advanced == [1]
+    assert mixer.take_next1() is None
+
+def test_skip_moves_to_the_queued_source():
+    first, second = Tone(1000, 10), Tone(2000, 10)
+    mixer = libTempo.Mixer(first)
+    mixer.set_next1(second)
+    mixer.skip()
+    assert (frame(mixer.read()) == 2000).all()
+    assert first.cleaned
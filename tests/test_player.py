@@ -0,0 +1,202 @@
+import asyncio
+import time
+import libTempo
+
+
+class Voice:
+    # stands in for the voice client, the test reads the mixer instead of an audio thread
+    def __init__(self):
+        self.source = None
+        self.after = None
+        self.paused = False
+        self.connected = True
+
+    def is_playing(self):
+        return self.source is not None and not self.paused
+
+    def is_paused(self):
+        return self.paused
+
+    def play(self, source, after=None):
+        self.source = source
+        self.after = after
+
+    def stop(self):
+        if self.source is not None:
+            self.source = None
+            self.after(None)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    async def disconnect(self):
+        self.connected = False
+
+    def pump(self):
+        # one 20ms read, like the audio thread, finishing the way discord does when the source runs dry
+        data = self.source.read() if self.is_playing() else b''
+        if self.source is not None and not data:
+            self.stop()
+        return data
+
+class VoiceChannel:
+    def __init__(self, gate=None):
+        self.gate = gate
+
+    async def connect(self, cls=None):
+        if self.gate is not None:
+            await self.gate.wait()
+        return Voice()
+
+class Stream:
+    def __init__(self, name, frames):
+        self.name = name
+        self.frames = frames
+        self.cleaned = False
+
+    def read(self):
+        if self.frames <= 0:
+            return b''
+        self.frames -= 1
+        return self.name.encode() * libTempo.FRAME_BYTES
+
+    def cleanup(self):
+        self.cleaned = True
+
+class Backend:
+    # song urls are "name:frames"
+    def __init__(self):
+        self.streams = {}
+
+    async def getstream(self, url, user=None):
+        name, frames = url.split(":")
+        stream = self.streams[name] = Stream(name, int(frames))
+        return stream
+
+def song(name, frames):
+    return libTempo.Song(1, name, "Artist", "fake", 0, f"{name}:{frames}")
+
+async def settle():
+    # lets the player and its prefetch tasks catch up with what the audio side did
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+async def start(*songs):
+    backend = Backend()
+    player = libTempo.MusicPlayer({"fake": backend})
+    player.vc = Voice()
+    player.add_songs(list(songs))
+    player.play()
+    await settle()
+    return player, backend
+
+def heard(data):
+    return data[:1].decode() if data else None
+
+def registry():
+    return libTempo.PlayerRegistry(lambda: libTempo.MusicPlayer({}))
+
+
+def test_stop_bumps_the_generation():
+    player = libTempo.MusicPlayer({})
+    generation = player.generation
+    player.stop()
+    assert player.generation == generation + 1
+
+def test_get_does_not_create_players():
+    players = registry()
+    assert players.get(1) is None
+    assert len(players) == 0
+    player = players[1]
+    assert players.get(1) is player
+
+def test_commands_count_as_use():
+    players = registry()
+    player = players[1]
+    player.idlesince = 0
+    players.get(1)
+    assert player.idlesince > 0
+    player.idlesince = 0
+    players[1]
+    assert player.idlesince > 0
+
+def test_idle_players_are_reaped_and_their_settings_kept():
+    players = registry()
+    player = players[1]
+    player.mixer.set_crossfade(3)
+    player.playlist.SetLoop(1)
+    player.idlesince = time.monotonic() - 100
+    players.reap(10)
+    assert players.get(1) is None
+    replacement = players[1]
+    assert replacement is not player
+    assert replacement.mixer.crossfade == 3 and replacement.playlist.loop == 1
+
+def test_recently_used_players_are_kept():
+    players = registry()
+    player = players[1]
+    players.reap(10)
+    assert players.get(1) is player
+
+def test_players_joining_a_channel_are_not_reaped():
+    async def run():
+        players = registry()
+        player = players[1]
+        gate = asyncio.Event()
+        join = asyncio.create_task(player.join_channel(VoiceChannel(gate)))
+        await asyncio.sleep(0)
+        player.idlesince = time.monotonic() - 100
+        players.reap(10)
+        kept = players.get(1) is player
+        gate.set()
+        await join
+        return kept, player.vc is not None and player._joining == 0
+    assert asyncio.run(run()) == (True, True)
+
+def test_queue_plays_through_gaplessly():
+    async def run():
+        player, backend = await start(song("A", 3), song("B", 3), song("C", 3))
+        voice = player.vc
+        played = []
+        while voice.connected:
+            played.append(heard(voice.pump()))
+            await settle()
+        return played, backend, player
+    played, backend, player = asyncio.run(run())
+    assert played[:9] == list("AAABBBCCC")
+    assert all(stream.cleaned for stream in backend.streams.values())
+    assert not player.active and len(player.playlist) == 0
+
+def test_removing_the_song_the_mixer_just_moved_to_keeps_it_playing():
+    async def run():
+        player, backend = await start(song("A", 2), song("B", 50), song("C", 50))
+        voice = player.vc
+        # the audio side moves on to B, the event loop has not seen the advance yet
+        voice.pump()
+        voice.pump()
+        assert heard(voice.pump()) == "B"
+        player.playlist.delete(1)
+        stream = backend.streams["B"]
+        kept = not stream.cleaned and player.mixer.source1 is stream
+        await settle()
+        after = heard(voice.pump())
+        player.stop()
+        await settle()
+        return kept, after
+    kept, after = asyncio.run(run())
+    assert kept
+    assert after == "B"
+
+def test_skip_moves_on_to_the_prefetched_song():
+    async def run():
+        player, backend = await start(song("A", 50), song("B", 50))
+        voice = player.vc
+        voice.pump()
+        player.skip()
+        now = heard(voice.pump())
+        await settle()
+        return now, backend.streams["A"].cleaned, player.playlist.GetCurrentEntry().title
+    assert asyncio.run(run()) == ("B", True, "B")
@@ -0,0 +1,79 @@
+import libTempo
+
+
+def titles(playlist):
+    return playlist.getAll()
+
+def test_next_drops_the_current_song():
+    playlist = libTempo.Playlist("queue", ["a", "b", "c"])
+    playlist.next()
+    assert titles(playlist) == ["b", "c"]
+    assert playlist.GetCurrentEntry() == "b"
+
+def test_loop_queue_puts_the_current_song_at_the_back():
+    playlist = libTempo.Playlist("queue", ["a", "b", "c"])
+    playlist.SetLoop(1)
+    playlist.next()
+    assert titles(playlist) == ["b", "c", "a"]
+
+def test_loop_song_keeps_the_current_song():
+    playlist = libTempo.Playlist("queue", ["a", "b"])
+    playlist.SetLoop(2)
+    playlist.next()
+    assert titles(playlist) == ["a", "b"]
+
+def test_bad_loop_mode():
+    playlist = libTempo.Playlist("queue", [])
+    try:
+        playlist.SetLoop(3)
+    except ValueError:
+        return
+    assert False, "SetLoop accepted 3"
+
+def test_peek_follows_the_loop_mode():
+    playlist = libTempo.Playlist("queue", ["a", "b", "c"])
+    assert playlist.peek(2) == ["b", "c"]
+    assert playlist.peek(5) == ["b", "c"]
+    playlist.SetLoop(1)
+    assert playlist.peek(4) == ["b", "c", "a", "b"]
+    playlist.SetLoop(2)
+    assert playlist.peek(2) == ["a", "a"]
+    assert libTempo.Playlist("queue", []).peek() == []
+
+def test_move_and_delete():
+    playlist = libTempo.Playlist("queue", ["a", "b", "c", "d"])
+    playlist.move(3, 1)
+    assert titles(playlist) == ["a", "d", "b", "c"]
+    playlist.delete(2)
+    assert titles(playlist) == ["a", "d", "c"]
+    assert len(playlist) == 3
+
+def test_shuffle_keeps_the_current_song_and_unshuffle_restores_order():
+    songs = [str(i) for i in range(50)]
+    playlist = libTempo.Playlist("queue", songs)
+    playlist.SetShuffle(True)
+    assert playlist.GetCurrentEntry() == "0"
+    assert sorted(titles(playlist)) == sorted(songs)
+    playlist.SetShuffle(False)
+    assert titles(playlist) == songs
+
+def test_unshuffle_after_playing_and_adding():
+    playlist = libTempo.Playlist("queue", ["a", "b", "c"])
+    playlist.SetShuffle(True)
+    playlist.next()
+    playlist.add("d")
+    current = playlist.GetCurrentEntry()
+    playlist.SetShuffle(False)
+    assert titles(playlist) == [current] + [song for song in ["b", "c", "d"] if song != current]
+
+def test_changes_are_reported():
+    playlist = libTempo.Playlist("queue", ["a"])
+    calls = []
+    playlist.onchange = lambda: calls.append(1)
+    playlist.add("b")
+    playlist.extend(["c", "d"])
+    playlist.move(3, 1)
+    playlist.delete(1)
+    playlist.SetLoop(1)
+    playlist.SetShuffle(True)
+    assert len(calls) == 6
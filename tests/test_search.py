@@ -0,0 +1,121 @@
+import asyncio
+import libTempo
+
+
+def song(title, author, backend, length=200, url=None):
+    return libTempo.Song(1, title, author, backend, length, url or f"{backend}:{title}")
+
+def test_same_song_on_two_platforms_is_merged():
+    youtube = song("Song (Official Video)", "ArtistVEVO", "youtube", 201)
+    spotify = song("Song", "Artist", "spotify", 200)
+    assert libTempo._sametrack(youtube, spotify)
+    assert libTempo.mergeresults([youtube], [spotify]) == [youtube]
+
+def test_uploads_on_one_platform_are_kept_apart():
+    first = song("Song", "Artist", "youtube", url="a")
+    second = song("Song", "Artist", "youtube", url="b")
+    assert not libTempo._sametrack(first, second)
+    assert libTempo.mergeresults([first], [second]) == [first, second]
+
+def test_different_lengths_or_artists_are_kept_apart():
+    base = song("Song", "Artist", "youtube", 200)
+    assert not libTempo._sametrack(base, song("Song", "Artist", "spotify", 200 + libTempo.duplicate_length + 1))
+    assert not libTempo._sametrack(base, song("Song", "Someone Else", "spotify", 200))
+    # an unknown length does not rule a match out
+    assert libTempo._sametrack(song("Song", "Artist", "youtube", 0), song("Song", "Artist", "spotify", 200))
+
+def test_merge_keeps_earlier_results_in_place():
+    a, b = song("A", "x", "youtube"), song("B", "x", "youtube")
+    merged = libTempo.mergeresults([a], [song("A", "x", "spotify"), b])
+    assert merged == [a, b]
+
+
+class Backend:
+    def __init__(self, songs, delay=0, fail=False):
+        self.songs = songs
+        self.delay = delay
+        self.fail = fail
+
+    async def search(self, query, user, count=5, key=None):
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("search failed")
+        for found in self.songs[:count]:
+            yield found
+
+def collect(backends, keys, **kwargs):
+    async def run():
+        return [results async for results in libTempo.federated_search(backends, "song", None, keys, **kwargs)]
+    return asyncio.run(run())
+
+def test_federated_search_merges_every_platform():
+    backends = {
+        "youtube": Backend([song("A", "x", "youtube"), song("B", "x", "youtube")]),
+        "spotify": Backend([song("A", "x", "spotify"), song("C", "x", "spotify")], delay=0.05),
+    }
+    updates = collect(backends, {"youtube": None, "spotify": None})
+    assert [found.title for found in updates[0]] == ["A", "B"]
+    assert [found.title for found in updates[-1]] == ["A", "B", "C"]
+
+def test_federated_search_leaves_out_slow_and_broken_platforms():
+    backends = {
+        "youtube": Backend([song("A", "x", "youtube")]),
+        "slow": Backend([song("B", "x", "slow")], delay=5),
+        "broken": Backend([], fail=True),
+    }
+    updates = collect(backends, {"youtube": None, "slow": None, "broken": None}, timeout=0.2)
+    assert [found.title for found in updates[-1]] == ["A"]
+
+def test_federated_search_skips_unknown_platforms():
+    backends = {"youtube": Backend([song("A", "x", "youtube")])}
+    updates = collect(backends, {"youtube": None, "missing": None})
+    assert [found.title for found in updates[-1]] == ["A"]
+
+
+def test_user_backends_include_keyless_platforms(tmp_path, monkeypatch):
+    store = libTempo.UserStore(str(tmp_path / "users.db"))
+    monkeypatch.setattr(libTempo, "store", store)
+    store.get(0, {"Default": "spotify", "Key": "server"})
+    # youtube never has a key but is always usable
+    assert libTempo.getuserbackends(1) == {"spotify": "server", "youtube": None}
+    libTempo.setuserkey(1, "spotify", "mine")
+    libTempo.setuserplatform(1, "spotify")
+    assert libTempo.getuserbackends(1) == {"spotify": "mine", "youtube": None}
+    libTempo.setuserkey(2, "soundcloud", "theirs")
+    libTempo.rmuserkey(2, "soundcloud")
+    # a removed key is left behind as None and no longer counts
+    assert "soundcloud" not in libTempo.getuserbackends(2)
+    store.close()
+
+
+class ListBackend(Backend):
+    # older backends return the whole list at once
+    async def search(self, query, user, count=5, key=None):
+        return self.songs[:count]
+
+class SlowBackend(Backend):
+    # yields its results one at a time with a gap between them
+    async def search(self, query, user, count=5, key=None):
+        for found in self.songs[:count]:
+            await asyncio.sleep(self.delay)
+            yield found
+
+def test_searchsongs_takes_lists_and_generators():
+    async def run(backend):
+        return [found.title async for found in libTempo.searchsongs(backend, "song", None, count=2)]
+    songs = [song("A", "x", "youtube"), song("B", "x", "youtube"), song("C", "x", "youtube")]
+    assert asyncio.run(run(ListBackend(songs))) == ["A", "B"]
+    assert asyncio.run(run(Backend(songs))) == ["A", "B"]
+
+def test_results_stream_in_as_they_arrive():
+    backends = {"youtube": SlowBackend([song("A", "x", "youtube"), song("B", "x", "youtube")], delay=0.05)}
+    updates = collect(backends, {"youtube": None}, timeout=None)
+    assert [[found.title for found in results] for results in updates] == [["A"], ["A", "B"]]
+
+def test_federated_search_mixes_list_backends_in():
+    backends = {
+        "youtube": Backend([song("A", "x", "youtube")]),
+        "old": ListBackend([song("B", "x", "old")]),
+    }
+    updates = collect(backends, {"youtube": None, "old": None})
+    assert sorted(found.title for found in updates[-1]) == ["A", "B"]
@@ -0,0 +1,71 @@
+import asyncio
+import pytest
+
+pytest.importorskip("librespot")
+pytest.importorskip("spotipy")
+import spotify
+
+
+class Session:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class Builder:
+    def stored(self, key):
+        return self
+
+    def create(self):
+        return Session()
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(spotify.lbc.Session, "Builder", Builder)
+    return spotify.SessionPool()
+
+def test_sessions_are_shared_per_key(pool):
+    async def run():
+        return await pool.session("key"), await pool.session("key"), await pool.session("other")
+    first, second, other = asyncio.run(run())
+    assert first is second and first is not other
+
+def test_leased_sessions_are_not_evicted(pool, monkeypatch):
+    session = asyncio.run(pool.session("key", lease=True))
+    monkeypatch.setattr(spotify, "session_idle_timeout", -1)
+    pool.evict()
+    assert not session.closed
+    pool.release("key", session)
+    pool.evict()
+    assert session.closed
+
+def test_drop_waits_for_the_last_lease(pool):
+    async def run():
+        return await pool.session("key", lease=True), await pool.session("key", lease=True)
+    session, _ = asyncio.run(run())
+    # a failed search on the credential drops it while two streams still play from it
+    pool.drop("key")
+    assert not session.closed
+    replacement = asyncio.run(pool.session("key"))
+    assert replacement is not session
+    pool.release("key", session)
+    assert not session.closed
+    pool.release("key", session)
+    assert session.closed
+    assert not replacement.closed
+
+def test_drop_closes_an_unleased_session(pool):
+    session = asyncio.run(pool.session("key"))
+    pool.drop("key")
+    assert session.closed
+
+def test_playlist_links_are_recognised():
+    assert spotify._parseplaylist("https://open.spotify.com/playlist/37i9dQZF1DXcBWIGoYBM5M?si=x") == ("playlist", "37i9dQZF1DXcBWIGoYBM5M")
+    assert spotify._parseplaylist("https://open.spotify.com/intl-de/album/1A2GTWGtFfWp7KSQTwWOyo") == ("album", "1A2GTWGtFfWp7KSQTwWOyo")
+    assert spotify._parseplaylist("spotify:album:1A2GTWGtFfWp7KSQTwWOyo") == ("album", "1A2GTWGtFfWp7KSQTwWOyo")
+
+def test_searches_are_not_playlists():
+    assert not spotify.isplaylist("track:Billie Jean album:Thriller")
+    assert not spotify.isplaylist("my playlist/best songs")
+    assert not spotify.isplaylist("https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC")
@@ -0,0 +1,85 @@
+import asyncio
+import time
+import libTempo
+
+
+def test_get_inserts_the_default(tmp_path):
+    store = libTempo.UserStore(str(tmp_path / "users.db"))
+    default = {"platform": "default", "keys": {"youtube": None}}
+    assert store.get(1) is None
+    assert store.get(1, default) == default
+    assert store.get(1) == default
+    store.close()
+
+def test_records_are_copies(tmp_path):
+    store = libTempo.UserStore(str(tmp_path / "users.db"))
+    data = store.get(1, {"keys": {}})
+    data["keys"]["spotify"] = "key"
+    assert store.get(1) == {"keys": {}}
+    store.save(1, data)
+    data["keys"]["spotify"] = "changed"
+    assert store.get(1)["keys"]["spotify"] == "key"
+    store.close()
+
+def test_saves_are_persisted(tmp_path):
+    path = str(tmp_path / "users.db")
+    store = libTempo.UserStore(path)
+    store.get(1, {"platform": "default"})
+    store.save(1, {"platform": "spotify"})
+    store.close()
+    assert libTempo.UserStore(path).get(1) == {"platform": "spotify"}
+
+def test_cache_is_bounded(tmp_path):
+    store = libTempo.UserStore(str(tmp_path / "users.db"), cachesize=2)
+    for id in range(5):
+        store.get(id, {"id": id})
+    assert list(store._cache) == [3, 4]
+    assert store.get(0) == {"id": 0}
+    store.close()
+
+
+def test_writes_from_another_process_are_seen(tmp_path):
+    # two stores on one file stand in for two shard processes
+    path = str(tmp_path / "users.db")
+    first, second = libTempo.UserStore(path), libTempo.UserStore(path)
+    first.get(1, {"platform": "default"})
+    assert second.get(1) == {"platform": "default"}
+    first.save(1, {"platform": "spotify"})
+    assert second.get(1) == {"platform": "spotify"}
+    first.close()
+    second.close()
+
+def shareddb(tmp_path, monkeypatch):
+    shared = libTempo.Database(str(tmp_path / "shared.db"), libTempo.shared.tables)
+    monkeypatch.setattr(libTempo, "shared", shared)
+    return shared
+
+def test_shared_cache_is_seen_by_other_processes(tmp_path, monkeypatch):
+    shared = shareddb(tmp_path, monkeypatch)
+    first, second = libTempo.SharedTTLCache("test"), libTempo.SharedTTLCache("test")
+    first.set(("query", 5), {"url": "a"})
+    shared._executor.submit(lambda: None).result()
+    assert second.get(("query", 5)) is None
+    assert asyncio.run(second.aget(("query", 5))) == {"url": "a"}
+    # now held locally as well
+    assert second.get(("query", 5)) == {"url": "a"}
+    first.pop(("query", 5))
+    shared._executor.submit(lambda: None).result()
+    assert asyncio.run(libTempo.SharedTTLCache("test").aget(("query", 5))) is None
+
+def test_expired_shared_entries_are_missed(tmp_path, monkeypatch):
+    shared = shareddb(tmp_path, monkeypatch)
+    libTempo.SharedTTLCache("test").set("key", 1, ttl=0.01)
+    shared._executor.submit(lambda: None).result()
+    time.sleep(0.02)
+    assert asyncio.run(libTempo.SharedTTLCache("test").aget("key", "missing")) == "missing"
+
+def test_shared_cache_writes_leave_the_user_store_cache_alone(tmp_path, monkeypatch):
+    shared = shareddb(tmp_path, monkeypatch)
+    store = libTempo.UserStore(str(tmp_path / "users.db"))
+    store.get(1, {"platform": "default"})
+    libTempo.SharedTTLCache("test").set("key", 1)
+    shared._executor.submit(lambda: None).result()
+    store.get(1)
+    assert 1 in store._cache
+    store.close()
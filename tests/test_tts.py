@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+# tts loads torch and matcha when imported, nothing here runs the model itself
+pytest.importorskip("torch")
+pytest.importorskip("matcha")
+import tts
+
+
+def test_split_sentences():
+    assert tts.split_sentences("Up next. Then this!  And? ") == ["Up next.", "Then this!", "And?"]
+    assert tts.split_sentences("1. first song 2. second song") == ["1. first song 2. second song"]
+    assert tts.split_sentences("   ") == []
+
+def test_to_pcm_is_48khz_stereo():
+    pcm = tts.to_pcm(np.full(22050, 0.5, dtype=np.float32))
+    samples = np.frombuffer(pcm, dtype=np.int16).reshape(-1, 2)
+    assert len(samples) == 48000
+    assert (samples[:, 0] == samples[:, 1]).all()
+    assert abs(int(samples[100, 0]) - 16383) <= 1
+
+def test_to_pcm_clips():
+    samples = np.frombuffer(tts.to_pcm(np.array([2.0, -2.0] * 100, dtype=np.float32)), dtype=np.int16)
+    assert samples.max() == 32767 and samples.min() == -32768
@@ -0,0 +1,33 @@
+import numpy as np
+import libTempo
+
+
+def packets(rms, count, seed=0):
+    # 20ms packets of 48kHz stereo noise at roughly the given RMS
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        yield np.clip(rng.normal(0, rms, 1920), -32768, 32767).astype(np.int16).tobytes()
+
+def test_silence_is_not_speech():
+    vad = libTempo.VoiceActivity()
+    assert not any(vad.isvoiced(pcm) for pcm in packets(50, 100))
+    assert not vad.isvoiced(b'')
+
+def test_speech_over_a_quiet_background():
+    vad = libTempo.VoiceActivity()
+    for pcm in packets(100, 100):
+        vad.isvoiced(pcm)
+    assert all(vad.isvoiced(pcm) for pcm in packets(5000, 100, seed=1))
+
+def test_steady_loud_noise_stops_counting_as_speech():
+    # music bleed or a fan well above the threshold
+    vad = libTempo.VoiceActivity()
+    voiced = [vad.isvoiced(pcm) for pcm in packets(1200, 500)]
+    assert not any(voiced[-300:])
+    assert vad.noise > 1000
+
+def test_speech_is_still_heard_over_loud_noise():
+    vad = libTempo.VoiceActivity()
+    for pcm in packets(1200, 500):
+        vad.isvoiced(pcm)
+    assert all(vad.isvoiced(pcm) for pcm in packets(8000, 50, seed=1))
@@ -3,10 +3,10 @@ from pathlib import Path
 
 import IPython.display as ipd
 import numpy as np
-import soundfile as sf
 import torch
-from tqdm.auto import tqdm
-import io
+import re
+import threading
+from collections import OrderedDict
 # Hifigan imports
 from matcha.hifigan.config import v1
 from matcha.hifigan.denoiser import Denoiser
@@ -18,7 +18,7 @@ from matcha.text import sequence_to_text, text_to_sequence
 from matcha.utils.model import denormalize
 from matcha.utils.utils import get_user_data_dir, intersperse
 
-## Number of ODE Solver steps
+## Number of ODE Solver steps, fewer is faster but rougher
 n_timesteps = 10
 
 ## Changes to the speaking rate
@@ -41,8 +41,10 @@ def load_model(checkpoint_path):
     return model
 count_params = lambda x: f"{sum(p.numel() for p in x.parameters()):,}"
 
-
-model = load_model(MATCHA_CHECKPOINT)
+# loaded on first use by load(), not at import
+model = None
+vocoder = None
+denoiser = None
 
 def load_vocoder(checkpoint_path):
     h = AttrDict(v1)
@@ -52,8 +54,19 @@ def load_vocoder(checkpoint_path):
     hifigan.remove_weight_norm()
     return hifigan
 
-vocoder = load_vocoder(HIFIGAN_CHECKPOINT)
-denoiser = Denoiser(vocoder, mode='zeros')
+def load():
+    """Loads the MatchaTTS checkpoint and the HiFi-GAN vocoder, does nothing if they are already loaded."""
+    global model, vocoder, denoiser
+    if model is None:
+        model = load_model(MATCHA_CHECKPOINT)
+        vocoder = load_vocoder(HIFIGAN_CHECKPOINT)
+        denoiser = Denoiser(vocoder, mode='zeros')
+
+def unload():
+    global model, vocoder, denoiser
+    model = vocoder = denoiser = None
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
 @torch.inference_mode()
 def process_text(text: str):
@@ -89,36 +102,92 @@ def to_waveform(mel, vocoder):
     audio = vocoder(mel).clamp(-1, 1)
     audio = denoiser(audio.squeeze(0), strength=0.00025).cpu().squeeze()
     return audio.cpu().squeeze()
-    
-
-def generate(text):
-
-    text = [text]
-
-    outputs, rtfs = [], []
-    rtfs_w = []
-    for i, text in enumerate(tqdm(text)):
-        output = synthesise(text) #, torch.tensor([15], device=device, dtype=torch.long).unsqueeze(0))
-        output['waveform'] = to_waveform(output['mel'], vocoder)
-
-        # Compute Real Time Factor (RTF) with HiFi-GAN
-        t = (dt.datetime.now() - output['start_t']).total_seconds()
-        rtf_w = t * 22050 / (output['waveform'].shape[-1])
-
-        rtfs.append(output['rtf'])
-        rtfs_w.append(rtf_w)
-
-        ## Display the synthesised waveform
-        audio_bytesio = io.BytesIO()
-
-        waveform_bytes = output['waveform'].cpu().numpy().astype(np.int16)
-
 
-        sf.write(audio_bytesio, output['waveform'], 22050, 'PCM_24', format='WAV')
-
-
-        audio_data = audio_bytesio.getvalue()
-
-        audio_bytesio.seek(0)
+@torch.inference_mode()
+def synthesise_batch(texts, spks=None, steps=None):
+    """Synthesises several texts in a single forward pass, padding them to the longest one."""
+    processed = [process_text(text) for text in texts]
+    x_lengths = torch.tensor([p['x'].shape[-1] for p in processed], dtype=torch.long, device=device)
+    x = torch.zeros((len(processed), int(x_lengths.max())), dtype=torch.long, device=device)
+    for i, p in enumerate(processed):
+        x[i, :p['x'].shape[-1]] = p['x'][0]
+    return model.synthesise(
+        x,
+        x_lengths,
+        n_timesteps=n_timesteps if steps is None else steps,
+        temperature=temperature,
+        spks=spks,
+        length_scale=length_scale
+    )
 
-        return audio_bytesio
+@torch.inference_mode()
+def to_waveforms(mel, mel_lengths):
+    """Runs the vocoder over a batch of mels, returning one trimmed waveform per item."""
+    audio = vocoder(mel).clamp(-1, 1)
+    audio = denoiser(audio.squeeze(1), strength=0.00025).cpu().reshape(len(mel), -1)
+    # HiFi-GAN produces 256 samples per mel frame, padding past each items own length is dropped
+    return [audio[i, :int(mel_lengths[i]) * 256].numpy() for i in range(len(mel))]
+
+
+## Number of synthesised phrases kept in memory
+cache_size = 128
+
+# (text, voice parameters) -> 48kHz stereo 16 bit PCM
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def to_pcm(waveform, rate=22050):
+    """Resamples a float waveform to the 48kHz stereo 16 bit PCM discord plays, so FFmpeg isnt needed."""
+    waveform = np.asarray(waveform, dtype=np.float32)
+    count = int(len(waveform) * 48000 / rate)
+    positions = np.arange(count, dtype=np.float32) * (rate / 48000)
+    audio = np.interp(positions, np.arange(len(waveform), dtype=np.float32), waveform)
+    audio = np.clip(audio * 32767, -32768, 32767).astype(np.int16)
+    # same sample on both channels
+    return np.repeat(audio, 2).tobytes()
+
+def split_sentences(text):
+    # numbered items like "1. song" stay with their sentence
+    return [sentence for sentence in re.split(r'(?<=[^\d\s][.!?])\s+', text.strip()) if sentence]
+
+def _cachekey(text, spks, steps):
+    speaker = None if spks is None else tuple(spks.flatten().tolist())
+    return (text, steps, temperature, length_scale, speaker)
+
+def generate_pcm_batch(texts, spks=None, steps=None):
+    """Synthesises several texts straight to 48kHz stereo PCM, batching every phrase that isnt cached yet."""
+    if steps is None:
+        steps = n_timesteps
+    keys = [_cachekey(text, spks, steps) for text in texts]
+    results = {}
+    with _cache_lock:
+        for key in keys:
+            if key in _cache:
+                _cache.move_to_end(key)
+                results[key] = _cache[key]
+    missing = list(dict.fromkeys(key for key in keys if key not in results))
+    if missing:
+        load()
+        batchspks = None if spks is None else spks.expand(len(missing), *spks.shape[1:])
+        output = synthesise_batch([key[0] for key in missing], batchspks, steps)
+        waveforms = to_waveforms(output['mel'], output['mel_lengths'])
+        with _cache_lock:
+            for key, waveform in zip(missing, waveforms):
+                results[key] = _cache[key] = to_pcm(waveform)
+            while len(_cache) > cache_size:
+                _cache.popitem(last=False)
+    return [results[key] for key in keys]
+
+def generate_pcm(text, spks=None, steps=None):
+    """Synthesises text straight to 48kHz stereo PCM, reusing the result if the phrase was said before."""
+    return generate_pcm_batch([text], spks, steps)[0]
+
+def stream(text, spks=None, steps=None):
+    """Yields PCM one sentence at a time, so playback can start before the whole text is synthesised."""
+    sentences = split_sentences(text)
+    if len(sentences) == 0:
+        return
+    # the first sentence goes on its own so it can start playing, the rest share one forward pass
+    yield generate_pcm(sentences[0], spks, steps)
+    if len(sentences) > 1:
+        yield from generate_pcm_batch(sentences[1:], spks, steps)
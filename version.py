@@ -0,0 +1 @@
+version = "2.0.0"